@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter
+from urllib.parse import urlparse
+
+import m3u8
+from m3u8 import Segment
+
+
+def get_uri(segment: Segment) -> str:
+    try:
+        return segment.absolute_uri
+    except ValueError:
+        return segment.uri
+
+
+def get_prefix(segment: Segment) -> str:
+    path = urlparse(get_uri(segment)).path
+    name = re.sub(r'\d+$', '', os.path.splitext(os.path.basename(path))[0])
+
+    return '%s/%s' % (os.path.dirname(path), name)
+
+
+def get_host(segment: Segment) -> str:
+    return urlparse(get_uri(segment)).netloc
+
+
+class Run:
+    def __init__(self, start: int):
+        self.start = start
+        self.segments = []
+        self.score = 0
+        self.skipped = False
+
+    @property
+    def indexes(self) -> range:
+        return range(self.start, self.start + len(self.segments))
+
+    @property
+    def duration(self) -> float:
+        return sum(segment.duration or 0 for segment in self.segments)
+
+    @property
+    def prefix(self) -> str:
+        return Counter(get_prefix(segment) for segment in self.segments).most_common(1)[0][0]
+
+    @property
+    def prefix_share(self) -> float:
+        return Counter(get_prefix(segment) for segment in self.segments).most_common(1)[0][1] / len(self.segments)
+
+    @property
+    def host(self) -> str:
+        return Counter(get_host(segment) for segment in self.segments).most_common(1)[0][0]
+
+
+class AdDetector:
+    def __init__(self, max_duration: float = 120, max_share: float = 0.1, threshold: int = 3, stable_prefix: float = 0.8):
+        self.max_duration = max_duration
+        self.max_share = max_share
+        self.threshold = threshold
+        self.stable_prefix = stable_prefix
+
+    def analyze(self, playlist: m3u8.M3U8) -> list:
+        runs = []
+        for index, segment in enumerate(playlist.segments):
+            if len(runs) == 0 or segment.discontinuity:
+                runs.append(Run(index))
+            runs[-1].segments.append(segment)
+
+        if len(runs) < 2:
+            return runs
+
+        total = sum(run.duration for run in runs) or 1
+        prefixes = Counter()
+        hosts = Counter()
+        for run in runs:
+            prefixes[run.prefix] += run.duration
+            hosts[run.host] += run.duration
+        prefix = prefixes.most_common(1)[0][0]
+        host = hosts.most_common(1)[0][0]
+        # hashed segment names give every segment a prefix of its own, then a foreign name means nothing
+        named = max(runs, key=lambda run: run.duration).prefix_share >= self.stable_prefix
+
+        for run in runs:
+            # a foreign name or host is a strong hint, being short on its own is not
+            run.score = 2 * (named and run.prefix != prefix) + 2 * (run.host != host)
+            run.score += run.duration <= self.max_duration and run.duration / total <= self.max_share
+            run.skipped = run.score >= self.threshold
+
+        return runs
+
+    @staticmethod
+    def skipped(runs: list) -> list:
+        return [index for run in runs if run.skipped for index in run.indexes]
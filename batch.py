@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+from typing import Iterable
+
+from client import Http
+from crawlers import Page
+from main import Downloader, create, export
+from profiler import Profiler
+from progress import BOARD
+from state import StateStore
+from utils import Logger
+
+
+class Job:
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.id = spec.get('id') or hashlib.sha1(
+            json.dumps(spec, sort_keys=True, ensure_ascii=False).encode('utf-8')
+        ).hexdigest()
+
+    @property
+    def name(self) -> str:
+        return self.spec['name']
+
+    def is_page(self) -> bool:
+        # a direct m3u8 skips the crawler
+        return 'm3u8' in self.spec
+
+    def page(self) -> Page:
+        return Page(self.name, self.spec.get('episode', 1), self.spec.get('url', self.spec['m3u8']), self.spec['m3u8'])
+
+
+def read_jobs(filename: str, logger: Logger = None):
+    logger = Logger() if logger is None else logger
+    with open(filename, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if line.strip() == '':
+                continue
+
+            try:
+                spec = json.loads(line)
+            except ValueError as e:
+                logger.warning('job: %s:%d %s' % (filename, number, e))
+                continue
+
+            if not isinstance(spec, dict) or 'name' not in spec or not ('url' in spec or 'm3u8' in spec):
+                logger.warning('job: %s:%d needs a name and a url or an m3u8' % (filename, number))
+                continue
+
+            yield Job(spec)
+
+
+class BatchRunner:
+    def __init__(self, downloader: Downloader, state: StateStore, jobs: int = 2, logger: Logger = None):
+        self.downloader = downloader
+        self.state = state
+        self.jobs = jobs
+        self.__logger = Logger() if logger is None else logger
+
+    async def run(self, jobs: Iterable[Job]):
+        # jobs are read as slots free up, a long file is never loaded at once
+        heartbeat = asyncio.ensure_future(self.__heartbeat())
+        semaphore = asyncio.Semaphore(self.jobs)
+        tasks = []
+        try:
+            for job in jobs:
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(self.__run(job, semaphore)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def __run(self, job: Job, semaphore: asyncio.Semaphore):
+        try:
+            if not self.state.claim_job(job.id, json.dumps(job.spec, ensure_ascii=False)):
+                self.__logger.success('job: %s %s' % (job.name, self.state.job(job.id)['status']))
+                return
+
+            try:
+                done = await self.__execute(job)
+            except Exception as e:
+                self.state.finish_job(job.id, 'failed', str(e))
+                self.__logger.error('job: %s failed: %s' % (job.name, e))
+                return
+            except BaseException:
+                # interrupted, the next run starts it again
+                self.state.finish_job(job.id, 'pending')
+                raise
+
+            self.state.finish_job(job.id, 'done' if done else 'failed')
+        finally:
+            semaphore.release()
+
+    async def __execute(self, job: Job) -> bool:
+        if job.is_page():
+            return await self.downloader.m3u8_downloader.download(job.page())
+
+        spec = job.spec
+        results = await self.downloader.download(job.name, spec['url'], spec.get('start'), spec.get('end'))
+        failed = [episode for episode, done in results.items() if not done]
+        if len(failed) > 0:
+            self.__logger.error('job: %s episodes failed: %s' % (job.name, ', '.join(failed)))
+
+        return len(failed) == 0
+
+    async def __heartbeat(self):
+        # a job may run for longer than its lease, another runner must not take it meanwhile
+        while True:
+            await asyncio.sleep(self.state.lease / 3)
+            self.state.heartbeat()
+
+
+async def main(
+        filename: str = 'jobs.jsonl',
+        jobs: int = 2,
+        episodes: int = 3,
+        root: str = 'video',
+        metrics_port: int = None,
+        profile: str = None
+):
+    async with Http() as client:
+        downloader = create(client, root, episodes)
+        async with downloader, export(root, metrics_port), BOARD, Profiler(profile):
+            await BatchRunner(downloader, downloader.m3u8_downloader.state, jobs).run(read_jobs(filename))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download every series or episode listed in a JSONL file')
+    parser.add_argument('filename', nargs='?', default='jobs.jsonl')
+    parser.add_argument('--jobs', type=int, default=2, help='series downloaded at once')
+    parser.add_argument('--episodes', type=int, default=3, help='episodes of one series downloaded at once')
+    parser.add_argument('--root', default='video')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on localhost')
+    parser.add_argument('--profile', metavar='DIRECTORY', help='write trace.json and profile.txt there')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.filename, args.jobs, args.episodes, args.root, args.metrics_port, args.profile))
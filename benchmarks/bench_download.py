@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from client import Http  # noqa: E402
+from crawlers import Page  # noqa: E402
+from hls_server import HLSServer  # noqa: E402
+from m3u8_downloader import M3U8Downloader  # noqa: E402
+from measure import run_isolated  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from utils import Logger  # noqa: E402
+
+RESULTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+COLUMNS = (
+    ('episodes', 'episodes', '%10d'),
+    ('segments_per_second', 'seg/s', '%10.1f'),
+    ('mb_per_second', 'MB/s', '%10.1f'),
+    ('p50_ms', 'p50 ms', '%10.1f'),
+    ('p99_ms', 'p99 ms', '%10.1f'),
+    ('merge_seconds', 'merge s', '%10.2f'),
+    ('peak_rss_mb', 'RSS MB', '%10.1f'),
+    ('seconds', 'seconds', '%10.2f'),
+)
+
+
+class Recorder(Metrics):
+    # histograms only keep buckets, percentiles need every sample
+    def __init__(self):
+        super().__init__()
+        self.samples = {}
+
+    def observe(self, name: str, value: float, **labels):
+        super().observe(name, value, **labels)
+        self.samples.setdefault(name, []).append(value)
+
+
+class QuietLogger(Logger):
+    @classmethod
+    def _write(cls, message):
+        pass
+
+
+def percentile(values: list, q: float) -> float:
+    if len(values) == 0:
+        return 0
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def download(base: str, episodes: int, parallel: int, options: dict, root: str) -> dict:
+    metrics = Recorder()
+    async with Http(metrics=metrics) as client:
+        downloader = M3U8Downloader(
+            root,
+            client,
+            QuietLogger(),
+            concurrency=options['concurrency'],
+            keep_segments=options['keep_segments'],
+            budget=client.limit_per_host,
+            metrics=metrics
+        )
+        semaphore = asyncio.Semaphore(parallel)
+
+        async def run(episode: int) -> bool:
+            async with semaphore:
+                page = Page('bench', episode, base, '%s/%d/index.m3u8' % (base, episode))
+                return await downloader.download(page)
+
+        async with downloader:
+            started = time.perf_counter()
+            done = await asyncio.gather(*[run(episode) for episode in range(1, episodes + 1)])
+            elapsed = time.perf_counter() - started
+
+    latencies = metrics.samples.get('segment_seconds', [])
+
+    return {
+        'episodes': sum(done),
+        'segments': len(latencies),
+        'seconds': elapsed,
+        'segments_per_second': len(latencies) / elapsed,
+        'mb_per_second': metrics.total('segment_bytes_total') / 1024 / 1024 / elapsed,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'merge_seconds': metrics.seconds('merge_seconds'),
+        'retries': metrics.total('segment_retries_total'),
+    }
+
+
+def run(base: str, episodes: int, parallel: int, options: dict) -> dict:
+    root = tempfile.mkdtemp(dir=options['directory'])
+    try:
+        return asyncio.run(download(base, episodes, parallel, options, root))
+    finally:
+        shutil.rmtree(root)
+
+
+def serve(server: HLSServer, queue: multiprocessing.Queue):
+    async def main():
+        queue.put(await server.start())
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def read_previous(filename: str, scenario: str, params: dict) -> dict | None:
+    if not os.path.exists(filename):
+        return None
+
+    previous = None
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            # a run that lost episodes measured something else, it is no baseline
+            if record.get('failed'):
+                continue
+            if record['scenario'] == scenario and record['params'] == params:
+                previous = record
+
+    return previous
+
+
+def format_change(value: float, previous: dict | None, key: str) -> str:
+    if previous is None or not previous['result'].get(key):
+        return ''
+
+    return '%+.0f%%' % ((value / previous['result'][key] - 1) * 100)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download synthetic HLS from a local server and record the results')
+    parser.add_argument('--scenario', choices=['episode', 'series', 'all'], default='all')
+    parser.add_argument('--episodes', type=int, default=6, help='episodes of the series scenario')
+    parser.add_argument('--parallel', type=int, default=3, help='episodes of the series downloaded at once')
+    parser.add_argument('--segments', type=int, default=200)
+    parser.add_argument('--segment-kb', type=int, default=512)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--bandwidth-mbps', type=float, default=None, help='cap per response')
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--plain', action='store_true', help='serve unencrypted segments')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--spool', action='store_true', help='merge from memory instead of segment files')
+    parser.add_argument('--directory', default=None, help='where episodes are written (default: a temp dir)')
+    parser.add_argument('--results', default=RESULTS)
+    parser.add_argument('--label', default='', help='stored with the results, e.g. the change being measured')
+    args = parser.parse_args()
+
+    params = {
+        'segments': args.segments,
+        'segment_kb': args.segment_kb,
+        'latency_ms': args.latency_ms,
+        'bandwidth_mbps': args.bandwidth_mbps,
+        'error_rate': args.error_rate,
+        'encrypted': not args.plain,
+        'concurrency': args.concurrency,
+        'spool': args.spool,
+    }
+    options = {'concurrency': args.concurrency, 'keep_segments': not args.spool, 'directory': args.directory}
+    scenarios = {'episode': (1, 1), 'series': (args.episodes, args.parallel)}
+    if args.scenario != 'all':
+        scenarios = {args.scenario: scenarios[args.scenario]}
+
+    server = HLSServer(
+        episodes=max(episodes for episodes, _ in scenarios.values()),
+        segments=args.segments,
+        segment_size=args.segment_kb * 1024,
+        encrypted=not args.plain,
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_mbps * 1024 * 1024 / 8 if args.bandwidth_mbps else None,
+        error_rate=args.error_rate
+    )
+    # the server gets its own process, so it neither competes for the client's loop nor counts in its RSS
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(server, queue), daemon=True)
+    process.start()
+    base = queue.get()
+
+    commit = get_commit()
+    failed = []
+    try:
+        print('%d segments of %d KB per episode, %s' % (args.segments, args.segment_kb, base))
+        print('%-10s' % 'scenario' + ''.join('%10s' % title for _, title, _ in COLUMNS))
+        for scenario, (episodes, parallel) in scenarios.items():
+            scenario_params = dict(params, episodes=episodes, parallel=parallel)
+            result, rss = run_isolated(run, base, episodes, parallel, options)
+            result['peak_rss_mb'] = rss
+
+            previous = read_previous(args.results, scenario, scenario_params)
+            print('%-10s' % scenario + ''.join('%10s' % (pattern % result[key]) for key, _, pattern in COLUMNS))
+            if result['episodes'] < episodes:
+                failed.append(scenario)
+                print('%-10s only %d of %d episodes downloaded, not comparable' % ('FAILED', result['episodes'], episodes))
+            elif previous is not None:
+                print('%-10s' % ('vs %s' % (previous['commit'] or 'last')) + ''.join(
+                    '%10s' % format_change(result[key], previous, key) for key, _, _ in COLUMNS
+                ))
+
+            with open(args.results, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({
+                    'time': time.time(),
+                    'commit': commit,
+                    'label': args.label,
+                    'scenario': scenario,
+                    'params': scenario_params,
+                    'result': result,
+                    'failed': scenario in failed,
+                }, ensure_ascii=False) + '\n')
+    finally:
+        process.terminate()
+        process.join()
+
+    if len(failed) > 0:
+        sys.exit('failed: %s' % ', '.join(failed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from measure import run_isolated  # noqa: E402
+from merge import append_file, get_backends  # noqa: E402
+
+
+def read_write(files: list, output: str):
+    with open(output, 'ab') as fw:
+        for file in files:
+            with open(file, 'rb') as fr:
+                fw.write(fr.read())
+
+
+def kernel_copy(files: list, output: str, backends: list):
+    with open(output, 'wb', buffering=0) as fw:
+        for file in files:
+            append_file(file, fw, backends)
+
+
+def run(name: str, files: list, output: str) -> float:
+    if os.path.exists(output):
+        os.unlink(output)
+
+    started = time.perf_counter()
+    if name == 'read':
+        read_write(files, output)
+    else:
+        kernel_copy(files, output, [] if name == 'buffered' else [name])
+    os.sync()
+
+    return time.perf_counter() - started
+
+
+def make_segments(directory: str, total_mb: int, segments: int) -> list:
+    size = total_mb * 1024 * 1024 // segments
+    block = os.urandom(1024 * 1024)
+    files = []
+    for index in range(segments):
+        file = os.path.join(directory, '%05d.ts' % index)
+        with open(file, 'wb') as f:
+            remaining = size
+            while remaining > 0:
+                f.write(block[:min(remaining, len(block))])
+                remaining -= len(block)
+        files.append(file)
+
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare merge backends on synthetic .ts segments')
+    parser.add_argument('--size-mb', type=int, default=2048)
+    parser.add_argument('--segments', type=int, default=500)
+    parser.add_argument('--directory', default=None, help='where to create the segments (default: a temp dir)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(dir=args.directory)
+    try:
+        files = make_segments(directory, args.size_mb, args.segments)
+        output = os.path.join(directory, 'output.mp4')
+        total = sum(os.path.getsize(file) for file in files) / 1024 / 1024
+
+        print('%d segments, %.0f MB' % (len(files), total))
+        print('%-16s %10s %10s %14s' % ('backend', 'seconds', 'MB/s', 'peak RSS MB'))
+        for name in ['read', 'buffered'] + get_backends():
+            elapsed, rss = run_isolated(run, name, files, output)
+            print('%-16s %10.2f %10.1f %14.1f' % (name, elapsed, total / elapsed, rss))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+
+from aiohttp import web
+from Cryptodome.Cipher import AES
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import h264_sps, make_ts  # noqa: E402
+
+VARIANTS = {360: 640, 720: 1280, 1080: 1920}
+
+
+class HLSServer:
+    def __init__(
+            self,
+            episodes: int = 1,
+            segments: int = 100,
+            segment_size: int = 512 * 1024,
+            variants: tuple = (360, 720, 1080),
+            encrypted: bool = True,
+            latency: float = 0.0,
+            bandwidth: float = None,
+            error_rate: float = 0.0,
+            chunk_size: int = 64 * 1024,
+            seed: int = 0
+    ):
+        self.episodes = episodes
+        self.segments = segments
+        self.segment_size = segment_size
+        self.variants = variants
+        self.encrypted = encrypted
+        self.latency = latency
+        # bytes per second for each response, None for as fast as the loopback goes
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.errors = 0
+        self.__random = random.Random(seed)
+        self.__key = bytes(self.__random.getrandbits(8) for _ in range(16))
+        self.__bodies = {
+            height: make_ts(0x1b, h264_sps(VARIANTS[height], height), segment_size) for height in variants
+        }
+        self.__runner: web.AppRunner | None = None
+
+    def application(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/{episode}/index.m3u8', self.__master)
+        app.router.add_get('/{episode}/{height}p/index.m3u8', self.__playlist)
+        app.router.add_get('/{episode}/{height}p/{index}.ts', self.__segment)
+        app.router.add_get('/key.key', self.__get_key)
+
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self.__runner = web.AppRunner(self.application())
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host, port)
+        await site.start()
+        host, port = self.__runner.addresses[0][:2]
+
+        return 'http://%s:%d' % (host, port)
+
+    async def stop(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+        self.__runner = None
+
+    def url(self, base: str, episode: int) -> str:
+        return '%s/%d/index.m3u8' % (base, episode)
+
+    async def __master(self, request: web.Request) -> web.Response:
+        lines = ['#EXTM3U']
+        for height in self.variants:
+            width = VARIANTS[height]
+            lines.append('#EXT-X-STREAM-INF:BANDWIDTH=%d,RESOLUTION=%dx%d' % (width * height * 2, width, height))
+            lines.append('/%s/%dp/index.m3u8' % (request.match_info['episode'], height))
+
+        return await self.__respond('\n'.join(lines) + '\n')
+
+    async def __playlist(self, request: web.Request) -> web.Response:
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0']
+        if self.encrypted:
+            lines.append('#EXT-X-KEY:METHOD=AES-128,URI="/key.key"')
+        for index in range(self.segments):
+            lines.append('#EXTINF:4.000,')
+            lines.append('%05d.ts' % index)
+        lines.append('#EXT-X-ENDLIST')
+
+        return await self.__respond('\n'.join(lines) + '\n')
+
+    async def __get_key(self, request: web.Request) -> web.Response:
+        return await self.__respond(self.__key)
+
+    async def __segment(self, request: web.Request) -> web.StreamResponse:
+        if self.__random.random() < self.error_rate:
+            self.errors += 1
+            return await self.__respond(b'', status=503)
+
+        index = int(request.match_info['index'])
+        body = self.__bodies[int(request.match_info['height'])]
+        if self.encrypted:
+            # without an IV attribute the media sequence number is the IV
+            body = AES.new(self.__key, AES.MODE_CBC, index.to_bytes(16, 'big')).encrypt(
+                body + bytes([16 - len(body) % 16]) * (16 - len(body) % 16)
+            )
+
+        start = request.http_range.start or 0
+        return await self.__stream(request, body[start:], start, len(body))
+
+    async def __respond(self, body, status: int = 200) -> web.Response:
+        self.requests += 1
+        await self.__wait()
+        if isinstance(body, str):
+            return web.Response(text=body, status=status, content_type='application/vnd.apple.mpegurl')
+
+        return web.Response(body=body, status=status)
+
+    async def __stream(self, request: web.Request, body: bytes, start: int, total: int) -> web.StreamResponse:
+        self.requests += 1
+        await self.__wait()
+        response = web.StreamResponse(status=206 if start > 0 else 200)
+        response.content_length = len(body)
+        if start > 0:
+            response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, total - 1, total)
+        try:
+            await response.prepare(request)
+            for offset in range(0, len(body), self.chunk_size):
+                chunk = body[offset:offset + self.chunk_size]
+                await response.write(chunk)
+                if self.bandwidth:
+                    await asyncio.sleep(len(chunk) / self.bandwidth)
+            await response.write_eof()
+        except ConnectionResetError:
+            # the client cancelled it, e.g. the slower copy of a hedged segment
+            pass
+
+        return response
+
+    async def __wait(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * self.__random.uniform(0.5, 1.5))
+
+
+async def serve(server: HLSServer, port: int):
+    base = await server.start(port=port)
+    for episode in range(1, server.episodes + 1):
+        print(server.url(base, episode))
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve synthetic HLS episodes for benchmarks')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--episodes', type=int, default=1)
+    parser.add_argument('--segments', type=int, default=100)
+    parser.add_argument('--segment-kb', type=int, default=512)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=None, help='cap per response')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--plain', action='store_true', help='serve unencrypted segments')
+    args = parser.parse_args()
+
+    asyncio.run(serve(HLSServer(
+        episodes=args.episodes,
+        segments=args.segments,
+        segment_size=args.segment_kb * 1024,
+        encrypted=not args.plain,
+        latency=args.latency_ms / 1000,
+        bandwidth=args.bandwidth_mbps * 1024 * 1024 / 8 if args.bandwidth_mbps else None,
+        error_rate=args.error_rate
+    ), args.port))
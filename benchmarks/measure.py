@@ -0,0 +1,25 @@
+import multiprocessing
+import resource
+import sys
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return (rss / 1024 if sys.platform == 'darwin' else rss) / 1024
+
+
+def measure(queue: multiprocessing.Queue, target, args: tuple):
+    queue.put((target(*args), peak_rss_mb()))
+
+
+def run_isolated(target, *args) -> tuple:
+    # a fresh process per run, so ru_maxrss is not shared between runs; returns the result and the peak RSS
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=measure, args=(queue, target, args))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    return result
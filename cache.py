@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+
+from client import Http
+
+TTLS = {
+    'html': 60 * 60,
+    'master': 7 * 24 * 60 * 60,
+    'media': 24 * 60 * 60,
+    'key': 24 * 60 * 60,
+}
+
+
+def get_kind(kind: str, content: bytes) -> str:
+    # a playlist is only known to be a master or a media one once it is read
+    if kind != 'playlist':
+        return kind
+
+    return 'master' if b'#EXT-X-STREAM-INF' in content else 'media'
+
+
+class ResponseCache:
+    def __init__(self, http: Http, directory: str, ttls: dict = None, max_size: int = 64 * 1024 * 1024):
+        self.__http = http
+        self.directory = directory
+        self.ttls = {**TTLS, **({} if ttls is None else ttls)}
+        self.max_size = max_size
+
+    async def get(self, url: str, kind: str = 'html') -> bytes:
+        filename = self.__get_filename(url)
+        meta = self.__read_meta(filename)
+        if meta is not None and meta['stored'] + self.ttls.get(meta['kind'], 0) > time.time():
+            return self.__touch(filename)
+
+        headers = {}
+        if meta is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        status, response_headers, content = await self.__http.request(url, headers)
+        if status == 304 and meta is not None:
+            meta['stored'] = time.time()
+            self.__write(filename + '.json', json.dumps(meta).encode('utf-8'))
+            return self.__touch(filename)
+
+        self.__store(filename, url, get_kind(kind, content), response_headers, content)
+
+        return content
+
+    def __store(self, filename: str, url: str, kind: str, headers, content: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        meta = {
+            'url': url,
+            'kind': kind,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'stored': time.time(),
+        }
+        self.__write(filename, content)
+        self.__write(filename + '.json', json.dumps(meta).encode('utf-8'))
+        self.__evict()
+
+    def __evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            if not name.endswith('.json') and os.path.exists(filename + '.json'):
+                entries.append((os.path.getmtime(filename), os.path.getsize(filename), filename))
+
+        # least recently used first
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, filename in sorted(entries):
+            if size <= self.max_size:
+                break
+            for path in (filename, filename + '.json'):
+                if os.path.exists(path):
+                    os.unlink(path)
+            size -= entry_size
+
+    @staticmethod
+    def __touch(filename: str) -> bytes:
+        os.utime(filename)
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def __read_meta(filename: str) -> dict | None:
+        if not os.path.exists(filename) or not os.path.exists(filename + '.json'):
+            return None
+
+        with open(filename + '.json', 'rb') as f:
+            try:
+                return json.loads(f.read().decode('utf-8'))
+            except ValueError:
+                return None
+
+    @staticmethod
+    def __write(filename: str, content: bytes):
+        temp = filename + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(content)
+        os.replace(temp, filename)
+
+    def __get_filename(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
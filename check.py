@@ -1,19 +1,26 @@
+import argparse
 import glob
 import os
 
-
-def is_ts(file):
-    with open(file, 'rb') as f:
-        return b'G@\x11' in f.read(4)
+from validator import Validator
 
 
 def main():
-    directories = sorted(filter(lambda _file: os.path.isdir(_file), glob.glob(os.path.join('video', '*'))))
-    failed = []
-    for directory in directories:
-        files = sorted(glob.glob(os.path.join(directory, '*.ts')))
-        failed = failed + list(filter(lambda _file: is_ts(_file) is False, files))
-    print(failed)
+    parser = argparse.ArgumentParser(description='Validate every downloaded .ts segment')
+    parser.add_argument('root', nargs='?', default='video')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.root, '**', '*.ts'), recursive=True))
+    validator = Validator(args.processes)
+    try:
+        failed = [report for report in validator.check_all(files) if not report.ok]
+    finally:
+        validator.close()
+
+    for report in failed:
+        print(report)
+    print('%d/%d segments failed' % (len(failed), len(files)))
 
 
 if __name__ == '__main__':
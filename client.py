@@ -1,5 +1,14 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
 import aiohttp
 
+from metrics import REGISTRY, Metrics
+
 
 class Http:
     timeouts = (5, 10)
@@ -7,17 +16,101 @@ class Http:
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36'
     }
 
+    def __init__(
+            self,
+            limit: int = 100,
+            limit_per_host: int = 64,
+            keepalive_timeout: float = 30,
+            ttl_dns_cache: int = 300,
+            timeouts: tuple = None,
+            metrics: Metrics = None
+    ):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        if timeouts is not None:
+            self.timeouts = timeouts
+        self.metrics = REGISTRY if metrics is None else metrics
+        self.__session: aiohttp.ClientSession | None = None
+
+    async def __aenter__(self):
+        self.session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def session(self) -> aiohttp.ClientSession:
+        if self.__session is None or self.__session.closed:
+            connect, read = self.timeouts
+            conn = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+                use_dns_cache=True,
+            )
+            self.__session = aiohttp.ClientSession(
+                connector=conn,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read),
+                headers=self.headers,
+                trust_env=True,
+            )
+
+        return self.__session
+
+    async def close(self):
+        if self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+        self.__session = None
+
     async def get(self, url: str) -> bytes:
-        conn = aiohttp.TCPConnector(limit_per_host=1)
-        async with aiohttp.ClientSession(connector=conn, trust_env=True) as session:
-            async with session.get(url, headers=self.headers) as response:
-                response.raise_for_status()
+        async with self.__request('get', url, self.headers) as response:
+            response.raise_for_status()
 
-                return await response.read()
+            return self.__count(url, await response.read())
+
+    async def request(self, url: str, headers: dict = None) -> tuple:
+        # for conditional requests: a 304 comes back without a body instead of raising
+        headers = {**self.headers, **({} if headers is None else headers)}
+        async with self.__request('get', url, headers) as response:
+            if response.status == 304:
+                return response.status, response.headers, None
+            response.raise_for_status()
+
+            return response.status, response.headers, self.__count(url, await response.read())
+
+    @asynccontextmanager
+    async def stream(self, url: str, offset: int = 0):
+        headers = self.headers if offset == 0 else {**self.headers, 'Range': 'bytes=%d-' % offset}
+        async with self.__request('get', url, headers) as response:
+            response.raise_for_status()
+
+            yield response
 
     async def head(self, url: str):
-        async with aiohttp.ClientSession() as session:
-            async with session.head(url, headers=self.headers) as response:
-                response.raise_for_status()
+        async with self.__request('head', url, self.headers) as response:
+            response.raise_for_status()
+
+            return response.headers
+
+    @asynccontextmanager
+    async def __request(self, method: str, url: str, headers: dict):
+        host = urlparse(url).netloc
+        started = time.monotonic()
+        try:
+            async with getattr(self.session(), method)(url, headers=headers) as response:
+                # time to first byte: the response headers are in
+                self.metrics.observe('http_ttfb_seconds', time.monotonic() - started, host=host)
+                self.metrics.count('http_requests_total', host=host, method=method.upper(), status=response.status)
+
+                yield response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.metrics.count('http_errors_total', host=host, error=type(e).__name__)
+            raise
+
+    def __count(self, url: str, content: bytes) -> bytes:
+        self.metrics.count('http_bytes_total', len(content), host=urlparse(url).netloc)
 
-                return response.headers
+        return content
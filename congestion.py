@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+import aiohttp
+
+
+def is_congestion(error: BaseException) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ServerTimeoutError, aiohttp.ServerDisconnectedError))
+
+
+class Backoff:
+    def __init__(self, base: float = 1, cap: float = 60):
+        self.base = base
+        self.cap = cap
+
+    def delay(self, tries: int) -> float:
+        # "full jitter": spread retries over the whole exponential window
+        return random.uniform(0, min(self.cap, self.base * 2 ** tries))
+
+
+class Sample:
+    def __init__(self, epoch: int = 0):
+        self.epoch = epoch
+        self.started = time.monotonic()
+        self.latency = None
+        self.size = 0
+
+    def respond(self):
+        self.latency = time.monotonic() - self.started
+
+
+class HostWindow:
+    def __init__(self, limit: float, minimum: int, maximum: int, decrease: float, tolerance: float):
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+        self.throughput = 0.0
+        self.epoch = 0
+        self.__waiters = []
+        self.__round_started = time.monotonic()
+        self.__round_bytes = 0
+        self.__round_count = 0
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_event_loop().create_future()
+            self.__waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # pass a wake-up we may have consumed on to the next waiter
+                self.wake()
+                raise
+            finally:
+                if waiter in self.__waiters:
+                    self.__waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        free = int(self.limit) - self.in_flight
+        for waiter in [waiter for waiter in self.__waiters if not waiter.done()][:max(free, 0)]:
+            waiter.set_result(None)
+
+    def succeeded(self, sample: Sample):
+        if sample.latency is not None:
+            self.latency = sample.latency if self.latency is None else 0.8 * self.latency + 0.2 * sample.latency
+            self.baseline = self.latency if self.baseline is None else min(self.baseline * 1.01, self.latency)
+
+        self.__round_bytes += sample.size
+        self.__round_count += 1
+        if self.__round_count < int(self.limit):
+            return
+
+        # one round is `limit` completions, roughly one RTT worth of work for the window
+        elapsed = max(time.monotonic() - self.__round_started, 1e-6)
+        throughput = self.__round_bytes / elapsed
+        stable = self.latency is None or self.latency <= self.baseline * self.tolerance
+        if stable and throughput >= self.throughput * 0.9:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.wake()
+        self.throughput = throughput
+        self.__reset_round()
+
+    def congested(self, sample: Sample):
+        # requests started before the last cut belong to the same burst, cut only once for it
+        if sample.epoch != self.epoch:
+            return
+
+        self.limit = max(self.minimum, int(self.limit * self.decrease))
+        self.epoch += 1
+        self.__reset_round()
+
+    def __reset_round(self):
+        self.__round_started = time.monotonic()
+        self.__round_bytes = 0
+        self.__round_count = 0
+
+
+class CongestionController:
+    def __init__(
+            self,
+            initial: int = 4,
+            minimum: int = 1,
+            maximum: int = 64,
+            decrease: float = 0.5,
+            tolerance: float = 2.0
+    ):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.__windows = {}
+
+    def window(self, url: str) -> HostWindow:
+        host = urlparse(url).netloc
+        if host not in self.__windows:
+            self.__windows[host] = HostWindow(self.initial, self.minimum, self.maximum, self.decrease, self.tolerance)
+
+        return self.__windows[host]
+
+    def limits(self) -> dict:
+        return {host: int(window.limit) for host, window in self.__windows.items()}
+
+    def throughput(self) -> float:
+        return sum(window.throughput for window in self.__windows.values())
+
+    @asynccontextmanager
+    async def slot(self, url: str):
+        window = self.window(url)
+        await window.acquire()
+        sample = Sample(window.epoch)
+        try:
+            yield sample
+        except BaseException as e:
+            if is_congestion(e):
+                window.congested(sample)
+            raise
+        else:
+            window.succeeded(sample)
+        finally:
+            window.release()
@@ -1,20 +1,38 @@
+from __future__ import annotations
+
+import asyncio
 import json
 import re
 from abc import ABC, abstractmethod
+from collections import deque
 from typing import Union
 from urllib.parse import urlparse
 
 from bs4 import BeautifulSoup
 
+from cache import ResponseCache
 from client import Http
+from metrics import REGISTRY, Metrics
+from mirrors import MirrorProber
 
 
 class Crawler(ABC):
-    def __init__(self, http: Http = None):
+    def __init__(
+            self,
+            http: Http = None,
+            lookahead: int = 8,
+            prober: MirrorProber = None,
+            cache: ResponseCache = None,
+            metrics: Metrics = None
+    ):
         self._http = Http() if http is None else http
+        self.lookahead = lookahead
+        self.prober = prober
+        self.cache = cache
+        self.metrics = REGISTRY if metrics is None else metrics
 
     async def _get_html(self, url):
-        response = await self._http.get(url)
+        response = await (self._http.get(url) if self.cache is None else self.cache.get(url, 'html'))
 
         return response.decode('utf-8')
 
@@ -22,24 +40,90 @@ class Crawler(ABC):
     def get_episodes(self, soup: BeautifulSoup, url: str):
         pass
 
+    def get_sources(self, soup: BeautifulSoup, url: str) -> list:
+        # the episode links of every play source, the active one first
+        return [self.get_episodes(soup, url)]
+
     async def pages(self, name: str, url: str, start: Union[int, str, None] = None, end: Union[int, str, None] = None):
         parsed = urlparse(url)
         base_url = '%s://%s' % (parsed.scheme, parsed.netloc)
 
-        soup = BeautifulSoup(await self._get_html(url), 'html.parser')
-        for link in self.get_episodes(soup, url):
-            url = f'{base_url}{link["href"]}'
-            _m3u8 = self.__get_m3u8(await self._get_html(url))
+        with self.metrics.timer('crawl_seconds', stage='listing'):
+            soup = BeautifulSoup(await self._get_html(url), 'html.parser')
+        sources = []
+        for links in self.get_sources(soup, url):
+            episodes = self.__get_episodes(links, base_url, start, end)
+            # pages may repeat a source, e.g. once for mobile and once for desktop
+            if len(episodes) > 0 and episodes not in sources:
+                sources.append(episodes)
+
+        if len(sources) == 0:
+            return
+
+        with self.metrics.timer('crawl_seconds', stage='rank'):
+            sources = await self.__rank(sources)
+        mirrors = [dict(reversed(source)) for source in sources[1:]]
 
+        # play pages are fetched ahead of the consumer, but yielded in episode order
+        window = deque()
+        try:
+            for episode, url in sources[0]:
+                alternatives = [source[episode] for source in mirrors if episode in source]
+                window.append((episode, url, alternatives, asyncio.ensure_future(self.__get_play_page(url))))
+                if len(window) >= self.lookahead:
+                    yield await self.__get_page(name, *window.popleft())
+
+            while len(window) > 0:
+                yield await self.__get_page(name, *window.popleft())
+        finally:
+            for _, _, _, html in window:
+                html.cancel()
+
+    async def __get_play_page(self, url: str) -> str:
+        with self.metrics.timer('crawl_seconds', stage='play'):
+            html = await self._get_html(url)
+        self.metrics.count('pages_total')
+
+        return html
+
+    async def mirror(self, page: Page, url: str) -> Page:
+        return Page(page.name, page.episode, url, self.__get_m3u8(await self._get_html(url)))
+
+    def __get_episodes(self, links: list, base_url: str, start, end) -> list:
+        episodes = []
+        for link in links:
             matched = re.search(r'第([\w\\.]+)集', link.text)
             episode = matched.group(1) if matched is not None else link.text.strip()
 
             try:
                 episode = int(episode)
-                if self.__allowed(episode, start, end):
-                    yield Page(name, episode, url, _m3u8)
+                if not self.__allowed(episode, start, end):
+                    continue
             except ValueError:
-                yield Page(name, episode, url, _m3u8)
+                pass
+            episodes.append((episode, f'{base_url}{link["href"]}'))
+
+        return episodes
+
+    async def __rank(self, sources: list) -> list:
+        if self.prober is None or len(sources) < 2:
+            return sources
+
+        # every source is judged by its first episode
+        async def resolve(source: list):
+            return self.__get_m3u8(await self._get_html(source[0][1]))
+
+        urls = await asyncio.gather(*[resolve(source) for source in sources], return_exceptions=True)
+        resolved = [(url, source) for url, source in zip(urls, sources) if isinstance(url, str)]
+        unresolved = [source for url, source in zip(urls, sources) if not isinstance(url, str)]
+        if len(resolved) == 0:
+            return sources
+        order = await self.prober.rank([url for url, _ in resolved])
+
+        return [resolved[index][1] for index in order] + unresolved
+
+    async def __get_page(self, name: str, episode: Union[int, str], url: str, mirrors: list, html: asyncio.Future):
+        return Page(name, episode, url, self.__get_m3u8(await html), mirrors)
 
     @staticmethod
     def __allowed(episode: int, start, end):
@@ -62,6 +146,11 @@ class Bowang(Crawler):
     def get_episodes(self, soup: BeautifulSoup, url: str):
         return soup.select(".play-tab-list.active .module-play-list-link")
 
+    def get_sources(self, soup: BeautifulSoup, url: str) -> list:
+        tabs = sorted(soup.select('.play-tab-list'), key=lambda tab: 'active' not in tab.get('class', []))
+
+        return [tab.select('.module-play-list-link') for tab in tabs]
+
 
 class Gimy(Crawler):
     def get_episodes(self, soup: BeautifulSoup, url: str):
@@ -71,13 +160,23 @@ class Gimy(Crawler):
 
         return soup.select(f'.playlist[class*="activeplayer"] li a[href^="{episode_prefix}"]')
 
+    def get_sources(self, soup: BeautifulSoup, url: str) -> list:
+        path = urlparse(url).path
+        series_prefix = path[0:path.find('-') + 1]
+        episode_prefix = path[0:path.rfind('-') + 1]
+
+        sources = [playlist.select(f'li a[href^="{series_prefix}"]') for playlist in soup.select('.playlist')]
+
+        return sorted(sources, key=lambda links: not links or not links[0]['href'].startswith(episode_prefix))
+
 
 class Page:
-    def __init__(self, name, episode: Union[int, str], url: str, m3u8_url: str):
+    def __init__(self, name, episode: Union[int, str], url: str, m3u8_url: str, mirrors: list = None):
         self.name = name
         self.episode = self.parse_episode(episode)
         self.url = url
         self.m3u8 = m3u8_url
+        self.mirrors = [] if mirrors is None else mirrors
 
     @staticmethod
     def parse_episode(episode: Union[int, str]) -> str:
@@ -88,11 +187,13 @@ class Page:
 
 
 class Factory(object):
-    def __init__(self, http: Http = None):
+    def __init__(self, http: Http = None, prober: MirrorProber = None, cache: ResponseCache = None):
         self.__http = Http() if http is None else http
+        self.__prober = prober
+        self.__cache = cache
 
     def create(self, url: str):
-        return eval(self.parse_name(url).capitalize())(self.__http)
+        return eval(self.parse_name(url).capitalize())(self.__http, prober=self.__prober, cache=self.__cache)
 
     @staticmethod
     def parse_name(url: str):
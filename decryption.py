@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Util.Padding import unpad
+
+
+def decrypt_blocks(key: bytes, iv: bytes, data: bytes) -> bytes:
+    return AES.new(key, AES.MODE_CBC, iv).decrypt(data)
+
+
+def get_segment_iv(iv: bytes | None, sequence: int) -> bytes:
+    # HLS: without an IV attribute the media sequence number is the IV
+    return iv if iv is not None else sequence.to_bytes(AES.block_size, 'big')
+
+
+class Decrypter:
+    def __init__(self, processes: int = None, threshold: int = 256 * 1024):
+        self.processes = processes
+        self.threshold = threshold
+        self.__executor: ProcessPoolExecutor | None = None
+
+    async def decrypt(self, key: bytes, iv: bytes, data: bytes) -> bytes:
+        if len(data) < self.threshold:
+            return decrypt_blocks(key, iv, data)
+
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(self.executor(), decrypt_blocks, key, iv, data)
+
+    def executor(self) -> ProcessPoolExecutor:
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(self.processes)
+
+        return self.__executor
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+        self.__executor = None
+
+
+class StreamDecryptor:
+    def __init__(self, key: bytes, iv: bytes, decrypter: Decrypter = None, batch_size: int = 4 * 1024):
+        self.key = key
+        self.batch_size = batch_size
+        self.__iv = iv
+        self.__decrypter = Decrypter() if decrypter is None else decrypter
+        self.__buffer = bytearray()
+
+    async def update(self, chunk: bytes) -> bytes:
+        # a network chunk is past the batch size, it goes out as it arrives; only the tail waits for more
+        self.__buffer += chunk
+        if len(self.__buffer) <= self.batch_size:
+            return b''
+
+        # the last whole block is held back, it carries the padding
+        size = (len(self.__buffer) - 1) // AES.block_size * AES.block_size
+
+        return await self.__decrypt(size)
+
+    async def finalize(self) -> bytes:
+        return unpad(await self.__decrypt(len(self.__buffer)), AES.block_size)
+
+    async def __decrypt(self, size: int) -> bytes:
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        if len(data) == 0:
+            return b''
+
+        iv, self.__iv = self.__iv, data[-AES.block_size:]
+
+        return await self.__decrypter.decrypt(self.key, iv, data)
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import os
+import time
+
+from m3u8 import Key
+
+from cache import ResponseCache
+from client import Http
+
+
+def get_key_iv(key: Key) -> bytes | None:
+    if key.iv is None:
+        return None
+    return bytes.fromhex(key.iv.replace("0x", ""))
+
+
+class KeyCache:
+    def __init__(self, http: Http, directory: str = None, ttl: float = 24 * 60 * 60, cache: ResponseCache = None):
+        self.__http = http
+        self.directory = directory
+        self.ttl = ttl
+        self.cache = cache
+        self.__keys = {}
+        self.__pending = {}
+
+    async def resolve(self, key: Key | None) -> tuple:
+        if key is None or key.method in (None, 'NONE'):
+            return None, None
+
+        return await self.get(key.absolute_uri), get_key_iv(key)
+
+    async def get(self, uri: str) -> bytes:
+        cached = self.__keys.get(uri)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        pending = self.__pending.get(uri)
+        if pending is None:
+            pending = asyncio.ensure_future(self.__load(uri))
+            self.__pending[uri] = pending
+            pending.add_done_callback(lambda _: self.__pending.pop(uri, None))
+
+        return await asyncio.shield(pending)
+
+    async def __load(self, uri: str) -> bytes:
+        filename = self.__get_filename(uri)
+        if self.cache is not None:
+            content = await self.cache.get(uri, 'key')
+        elif filename is not None and os.path.exists(filename) and os.path.getmtime(filename) + self.ttl > time.time():
+            with open(filename, 'rb') as f:
+                content = f.read()
+        else:
+            content = await self.__http.get(uri)
+            if filename is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(filename, 'wb') as f:
+                    f.write(content)
+
+        self.__keys[uri] = (time.time() + self.ttl, content)
+
+        return content
+
+    def __get_filename(self, uri: str) -> str | None:
+        if self.directory is None:
+            return None
+
+        return os.path.join(self.directory, hashlib.sha1(uri.encode('utf-8')).hexdigest() + '.key')
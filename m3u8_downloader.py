@@ -1,167 +1,567 @@
 from __future__ import annotations
 
 import asyncio
-import glob
 import os
-from concurrent.futures import ThreadPoolExecutor
+import time
+from functools import partial
 from urllib.parse import urlparse
 
+import aiohttp
 import m3u8
 from Cryptodome.Cipher import AES
-from Cryptodome.Util.Padding import unpad
 from m3u8 import Segment, Playlist, Key
 from requests import HTTPError
 
+from ads import AdDetector
+from cache import ResponseCache
 from client import Http
+from congestion import Backoff, CongestionController
 from crawlers import Page
-from utils import Logger, progressbar, ANSI, get_media_info, is_same_video
-
-
-def wrapper(coro):
-    return asyncio.run(coro)
+from decryption import Decrypter, StreamDecryptor, get_segment_iv
+from keys import KeyCache, get_key_iv
+from merge import ReorderBuffer, Spool
+from metrics import REGISTRY, Metrics
+from mpegts import PROBE_SIZE, probe
+from profiler import TRACER, Profiler
+from progress import BOARD, ProgressBoard
+from scheduler import Hedger, Progress, Scheduler
+from state import StateStore
+from utils import Logger, get_media_info, is_same_media
+from variants import VariantSelector
+from validator import InvalidSegment, Validator, is_transport_stream
 
 
 class Worker:
-    def __init__(self, http: Http, logger: Logger, directory: str, cipher: AES = None):
+    def __init__(
+            self,
+            http: Http,
+            logger: Logger,
+            directory: str,
+            keys: KeyCache = None,
+            state: StateStore = None,
+            episode: int = None,
+            chunk_size: int = 64 * 1024,
+            decrypter: Decrypter = None,
+            buffer: ReorderBuffer = None,
+            keep_segments: bool = True,
+            controller: CongestionController = None,
+            backoff: Backoff = None,
+            tries: int = 10,
+            validator: Validator = None,
+            metrics: Metrics = None,
+            board: ProgressBoard = None
+    ):
         self.__http = http
         self.__logger = logger
         self.directory = directory
-        self.cipher = cipher
+        self.keys = KeyCache(http) if keys is None else keys
+        self.chunk_size = chunk_size
+        self.decrypter = Decrypter() if decrypter is None else decrypter
+        self.buffer = buffer
+        self.keep_segments = keep_segments
+        self.controller = CongestionController() if controller is None else controller
+        self.backoff = Backoff() if backoff is None else backoff
+        self.tries = tries
+        self.validator = validator
+        self.metrics = REGISTRY if metrics is None else metrics
+        self.board = BOARD if board is None else board
+        self.state = StateStore() if state is None else state
+        self.episode = episode
+        if episode is None:
+            self.episode = self.state.episode(os.path.dirname(directory), os.path.basename(directory))
+
+    async def save_ts(self, segment: Segment, index: int, total: int, progress: Progress = None, hedged: bool = False):
+        host = urlparse(segment.absolute_uri).netloc
+        started = time.monotonic()
+        try:
+            with TRACER.task_span('segment', 'download', episode=self.directory, index=index, hedged=hedged):
+                source, status = await self.__save_ts(
+                    segment, index, total, Progress() if progress is None else progress, hedged
+                )
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            self.metrics.count('segments_total', host=host, status='failed')
+            raise
+
+        self.metrics.count('segments_total', host=host, status=status)
+        if status == 'downloaded':
+            self.metrics.observe('segment_seconds', time.monotonic() - started, host=host)
+        self.board.advance(self.episode, done=1)
+
+        return source
+
+    async def __save_ts(self, segment: Segment, index: int, total: int, progress: Progress, hedged: bool) -> tuple:
+        if not self.keep_segments:
+            # no segment directory: the body goes to the reorder buffer's spool
+            spool = await self.__retry(partial(self.__save_spool, segment, index, progress, hedged), segment, index, total)
+            return spool, 'downloaded'
 
-    async def save_ts(self, segment: Segment, index: int, total: int):
-        url = segment.absolute_uri
         filename = os.path.join(self.directory, ('%05d.ts' % index))
+        if self.validator is not None and await self.__store(self.state.is_complete, index, filename, segment.absolute_uri):
+            # finished by an earlier run, fetched again only when it turns out broken
+            report = await self.validator.check(filename)
+            if not report.ok:
+                self.__logger.warning('invalid: %s' % report)
+                os.unlink(filename)
+
+        status = 'cached'
+        while not await self.__store(self.state.is_complete, index, filename, segment.absolute_uri):
+            if not await self.__store(self.state.claim, index):
+                # another process is fetching it, the file is ours to use once it is done
+                await asyncio.sleep(1)
+                continue
 
-        prefix = 'download: %s.mp4 %05d/%05d'
-        tries = 0
-        while True:
             try:
-                headers = await self.__http.head(url)
-                filesize = int(headers['Content-Length'])
-                start = os.path.getsize(filename) if os.path.exists(filename) else 0
-                message = prefix % (self.directory, index, total)
-
-                if start == filesize:
-                    progressbar(start, filesize, message)
-                    return
-
-                response = await self.__http.get(url)
-                with open(filename, 'wb') as f:
-                    start = len(response)
+                await self.__retry(partial(self.__save_file, segment, index, filename, progress, hedged), segment, index, total)
+            except BaseException:
+                await asyncio.shield(self.__store(self.state.release, index))
+                raise
+            status = 'downloaded'
+            break
 
-                    if self.cipher is not None:
-                        response = unpad(self.cipher.decrypt(response), AES.block_size)
+        return filename, status
 
-                    f.write(response)
-                    progressbar(start, filesize, message)
-                return
+    async def __retry(self, attempt, segment: Segment, index: int, total: int):
+        tries = 0
+        while True:
+            try:
+                return await attempt()
             except (HTTPError, Exception) as e:
-                if os.path.exists(filename):
-                    os.unlink(filename)
-
-                if tries >= 10:
+                # a broken body is fetched once more, past that the server keeps sending the same bytes
+                if tries >= (min(self.tries, 1) if isinstance(e, InvalidSegment) else self.tries):
                     message = 'failed: %s.mp4 %05d/%05d: %s' % (self.directory, index, total, e)
                     self.__logger.error(message)
-                    return
+                    raise
 
                 tries = tries + 1
+                self.metrics.count('segment_retries_total', host=urlparse(segment.absolute_uri).netloc, error=type(e).__name__)
                 message = 'retry: %s.mp4 %05d/%05d: %s' % (self.directory, index, total, e)
                 self.__logger.warning(message)
-                await asyncio.sleep(10)
+                await asyncio.sleep(self.backoff.delay(tries))
+
+    async def __save_file(self, segment: Segment, index: int, filename: str, progress: Progress, hedged: bool):
+        url = segment.absolute_uri
+        # a hedged copy runs next to the original one and must not share its part
+        part = filename + ('.hedge.part' if hedged else '.part')
+        try:
+            if os.path.exists(filename) and not os.path.exists(part):
+                # written before the state store existed, only the server knows whether it is whole
+                headers = await self.__http.head(url)
+                if os.path.getsize(filename) == int(headers['Content-Length']):
+                    await self.__complete(segment, index, filename)
+                    return
+                os.unlink(filename)
+
+            key, iv = await self.__get_key(segment, index)
+            offset = self.__get_offset(part, key is not None)
+            try:
+                await self.__fetch(url, offset, key, iv, lambda resumed: open(part, 'ab' if resumed else 'wb'), progress)
+            except aiohttp.ClientResponseError as e:
+                if e.status != 416 or offset == 0:
+                    raise
+
+                # nothing left past the offset: either the part is whole or it is stale
+                headers = await self.__http.head(url)
+                if offset != int(headers['Content-Length']):
+                    os.unlink(part)
+                    raise
+
+            if self.validator is not None:
+                report = await self.validator.check(part)
+                if not report.ok:
+                    raise InvalidSegment('invalid: %s %s' % (url, '; '.join(report.errors)))
+
+            os.replace(part, filename)
+            await self.__complete(segment, index, filename)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise
+        except asyncio.CancelledError:
+            # keep the part for resuming, unless the other copy of a hedged segment already finished it
+            if (hedged or self.state.is_complete(self.episode, index, filename, url)) and os.path.exists(part):
+                os.unlink(part)
+            raise
+        except BaseException:
+            if os.path.exists(part):
+                os.unlink(part)
+            raise
+
+    async def __complete(self, segment: Segment, index: int, filename: str):
+        key_uri = segment.key.absolute_uri if segment.key is not None and segment.key.uri else None
+        await self.__store(self.state.complete, index, filename, segment.absolute_uri, key_uri)
+
+    async def __store(self, method, index: int, *args):
+        # sqlite may wait out its busy timeout on another process and complete() hashes the file
+        loop = asyncio.get_event_loop()
+
+        return await loop.run_in_executor(None, partial(method, self.episode, index, *args))
+
+    async def __save_spool(self, segment: Segment, index: int, progress: Progress, hedged: bool):
+        spool = self.buffer.open(index, 'hedge' if hedged else '')
+        try:
+            key, iv = await self.__get_key(segment, index)
+            await self.__fetch(segment.absolute_uri, 0, key, iv, lambda resumed: spool, progress)
+        except BaseException:
+            spool.discard()
+            raise
+
+        return spool
+
+    async def __get_key(self, segment: Segment, index: int) -> tuple:
+        key, iv = await self.keys.resolve(segment.key)
+        sequence = index if segment.media_sequence is None else segment.media_sequence
+
+        return key, get_segment_iv(iv, sequence)
+
+    async def __fetch(self, url: str, offset: int, key: bytes | None, iv: bytes, opener, progress: Progress):
+        async with self.controller.slot(url) as sample, self.__http.stream(url, offset) as response:
+            progress.start()
+            sample.respond()
+            resumed = response.status == 206
+            decryptor = None
+            if key is not None:
+                # a resumed request starts one block early, that block is the IV of the next one
+                if resumed:
+                    iv = await response.content.readexactly(AES.block_size)
+                decryptor = StreamDecryptor(key, iv, self.decrypter)
+
+            size = 0
+            decrypting = 0.0
+            with opener(resumed) as f:
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    size += len(chunk)
+                    sample.size += len(chunk)
+                    progress.size += len(chunk)
+                    self.board.advance(self.episode, size=len(chunk))
+                    if decryptor is not None:
+                        started = time.monotonic()
+                        chunk = await decryptor.update(chunk)
+                        decrypting += time.monotonic() - started
+                    f.write(chunk)
+
+                if decryptor is not None:
+                    started = time.monotonic()
+                    f.write(await decryptor.finalize())
+                    decrypting += time.monotonic() - started
+
+            self.metrics.count('segment_bytes_total', size, host=urlparse(url).netloc)
+            if decryptor is not None:
+                self.metrics.observe('decrypt_seconds', decrypting)
+
+    @staticmethod
+    def __get_offset(part: str, encrypted: bool) -> int:
+        if not os.path.exists(part):
+            return 0
+
+        size = os.path.getsize(part)
+        if not encrypted:
+            return size
+
+        size = size // AES.block_size * AES.block_size
+        with open(part, 'r+b') as f:
+            f.truncate(size)
+
+        return max(size - AES.block_size, 0)
 
 
 class M3U8Downloader:
-    def __init__(self, root: str = None, http: Http = None, logger: Logger = None):
+    def __init__(
+            self,
+            root: str = None,
+            http: Http = None,
+            logger: Logger = None,
+            concurrency: int = 64,
+            decrypter: Decrypter = None,
+            keys: KeyCache = None,
+            keep_segments: bool = True,
+            memory_budget: int = 64 * 1024 * 1024,
+            skip_ads: bool = True,
+            budget: int = None,
+            controller: CongestionController = None,
+            backoff: Backoff = None,
+            hedge_budget: float = 0.05,
+            variants: VariantSelector = None,
+            stall_timeout: float = 120,
+            playlist_tries: int = 5,
+            cache: ResponseCache = None,
+            state: StateStore = None,
+            validator: Validator = None,
+            metrics: Metrics = None,
+            board: ProgressBoard = None
+    ):
         self.__root = 'video' if root is None else root
         self.__http = Http() if http is None else http
         self.__logger = Logger() if logger is None else logger
-
-    async def download(self, page: Page):
+        self.__decrypter = Decrypter() if decrypter is None else decrypter
+        self.__cache = cache
+        self.state = StateStore() if state is None else state
+        self.validator = validator
+        self.metrics = REGISTRY if metrics is None else metrics
+        self.board = BOARD if board is None else board
+        self.__keys = KeyCache(self.__http, os.path.join(self.__root, '.keys'), cache=cache) if keys is None else keys
+        self.concurrency = concurrency
+        self.keep_segments = keep_segments
+        self.memory_budget = memory_budget
+        self.skip_ads = skip_ads
+        self.__ads = AdDetector()
+        self.budget = budget
+        self.__limiter = None
+        self.controller = CongestionController() if controller is None else controller
+        self.backoff = Backoff() if backoff is None else backoff
+        self.hedge_budget = hedge_budget
+        self.variants = VariantSelector() if variants is None else variants
+        self.stall_timeout = stall_timeout
+        self.playlist_tries = playlist_tries
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        # the decrypter's and validator's process pools start on first use and end with the downloader
+        self.__decrypter.close()
+        if self.validator is not None:
+            self.validator.close()
+
+    async def download(self, page: Page) -> bool:
         directory = self.__get_directory(page)
         temp = os.path.join(os.path.dirname(directory), page.episode + '.tmp.mp4')
         target = os.path.join(os.path.dirname(directory), page.episode + '.mp4')
 
+        episode = self.state.episode(page.name, page.episode, page.url, page.m3u8)
         if os.path.exists(target):
+            self.state.finish(episode, target)
             self.__logger.success(f'merged: {target}')
-            return
+            return True
 
-        progressbar(1, 2, 'm3u8: %s' % target)
+        self.board.start(episode, target)
+        try:
+            with TRACER.task_span('episode', 'download', target=target):
+                return await self.__download(page, episode, directory, temp, target)
+        finally:
+            self.board.finish(episode)
+
+    async def __download(self, page: Page, episode: int, directory: str, temp: str, target: str) -> bool:
+        tries = 0
         while True:
             try:
-                playlist = await self.__get_playlist(page)
+                with self.metrics.timer('playlist_seconds'):
+                    playlist = await self.__get_playlist(page)
                 break
             except (HTTPError, Exception) as e:
+                if tries >= self.playlist_tries:
+                    # a dead source: give up so the caller can try a mirror
+                    self.state.finish(episode, target, 'failed')
+                    self.__logger.error('failed: %s %s' % (target, e))
+                    return False
+
                 self.__logger.warning(e)
-                await asyncio.sleep(15)
-        progressbar(2, 2, 'm3u8: %s' % target)
+                await asyncio.sleep(self.backoff.delay(tries))
+                tries = tries + 1
 
-        cipher = await self.__get_cipher(playlist)
         total = len(playlist.segments)
+        self.board.update(episode, total=total)
+        for filename in self.state.start(episode, total):
+            if os.path.exists(filename):
+                os.unlink(filename)
+                self.__logger.warning(f'{filename} deleted')
 
-        worker = Worker(http=self.__http, logger=self.__logger, directory=directory, cipher=cipher)
-        if self.__is_files_equals(directory, total) is not True:
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                for index, segment in enumerate(playlist.segments):
-                    executor.submit(wrapper, worker.save_ts(segment, index, total))
-        progressbar(0, 1, 'merge: %s' % target)
-
-        files = self.find_ts(directory)
-        file_total = len(files)
-        if self.__is_files_equals(directory, total) is not True:
-            message = 'failed not equals: %s %05d/%05d' % (target, file_total, total)
-            progressbar(file_total, total, message, ANSI.failed)
-            print('')
-            return
+        done = self.state.count(episode)
+        if done > 0:
+            self.__logger.debug('resume: %s %05d/%05d' % (target, done, total))
+
+        skipped = set(AdDetector.skipped(self.__ads.analyze(playlist))) if self.skip_ads else set()
 
-        base_info = get_media_info(files[0])
         if os.path.exists(temp):
             os.unlink(temp)
 
-        try:
-            with open(temp, 'ab') as fw:
-                for index, file in enumerate(files):
-                    if is_same_video(file, base_info) is False:
-                        self.__logger.debug(f'adv: {file}')
-                        continue
+        with open(temp, 'wb', buffering=0) as fw:
+            buffer = ReorderBuffer(
+                fw,
+                accept=self.__accept(),
+                directory=os.path.dirname(directory),
+                prefix=page.episode,
+                memory_budget=self.memory_budget,
+                metrics=self.metrics
+            )
+            worker = Worker(
+                http=self.__http,
+                logger=self.__logger,
+                directory=directory,
+                keys=self.__keys,
+                state=self.state,
+                episode=episode,
+                decrypter=self.__decrypter,
+                buffer=buffer,
+                keep_segments=self.keep_segments,
+                controller=self.controller,
+                backoff=self.backoff,
+                validator=self.validator if is_transport_stream(playlist) else None,
+                metrics=self.metrics,
+                board=self.board
+            )
+            # ad runs found in the playlist are never fetched
+            for index in skipped:
+                await buffer.skip(index)
+
+            hedger = self.__get_hedger(total)
+            scheduler = Scheduler(self.concurrency, self.__get_limiter(), hedger)
+            for index, segment in enumerate(playlist.segments):
+                if index not in skipped:
+                    # only the fetch is raced, the winner's file is merged outside the race
+                    fetch = partial(worker.save_ts, segment, index, total)
+                    merge = partial(self.__merge, worker, buffer, index)
+                    scheduler.submit(index, fetch, hedge=partial(fetch, hedged=True), then=merge)
+
+            watchdog = asyncio.ensure_future(self.__watch(buffer, scheduler))
+            try:
+                await scheduler.join()
+            except Exception as e:
+                buffer.discard()
+                self.__logger.error('failed: %s %s' % (target, e))
+            finally:
+                watchdog.cancel()
+
+        if buffer.next != total:
+            self.state.finish(episode, target, 'failed')
+            os.unlink(temp)
+            self.__logger.error('failed not equals: %s %05d/%05d' % (target, buffer.next, total))
+            return False
+
+        if len(skipped) > 0:
+            self.__report_ads(playlist, skipped, os.path.getsize(temp), target)
+
+        if hedger is not None and hedger.hedged > 0:
+            self.__logger.debug('hedged: %s %d segments, %d won' % (target, hedger.hedged, hedger.won))
+
+        os.rename(temp, target)
+        self.state.finish(episode, target)
+        self.__logger.success('merged: %s %05d/%05d' % (target, buffer.next, total))
+
+        return True
+
+    async def __watch(self, buffer: ReorderBuffer, scheduler: Scheduler):
+        if self.stall_timeout is None:
+            return
+
+        received = buffer.received
+        changed = time.monotonic()
+        while True:
+            await asyncio.sleep(min(self.stall_timeout / 4, 1))
+            if buffer.received != received:
+                received = buffer.received
+                changed = time.monotonic()
+            elif time.monotonic() - changed > self.stall_timeout:
+                scheduler.cancel(TimeoutError('stalled: no segment in %ds' % self.stall_timeout))
+                return
+
+    def __report_ads(self, playlist: m3u8.M3U8, skipped: set, size: int, target: str):
+        duration = sum(segment.duration or 0 for segment in playlist.segments)
+        skipped_duration = sum(playlist.segments[index].duration or 0 for index in skipped)
+        kept_duration = duration - skipped_duration
+
+        # estimate the ads' size from the bitrate of what was actually downloaded
+        saved = size / kept_duration * skipped_duration if kept_duration > 0 else 0
+        message = 'ads: %s skipped %d segments, %.1fs, ~%.2f MB saved'
+        self.__logger.debug(message % (target, len(skipped), skipped_duration, saved / 1024 / 1024))
+
+    async def __merge(self, worker: Worker, buffer: ReorderBuffer, index: int, source):
+        await buffer.add(index, source)
+        self.board.update(worker.episode, merged=buffer.next)
+
+    def __accept(self):
+        base_info = None
+
+        def accept(source) -> bool:
+            nonlocal base_info
+            with self.metrics.timer('probe_seconds'):
+                info = self.__get_media_info(source)
+            if base_info is None:
+                base_info = info
 
-                    with open(file, 'rb') as fr:
-                        fw.write(fr.read())
-                    progressbar(index + 1, file_total, 'merging: %s %05d/%05d' % (target, index + 1, file_total))
+            if is_same_media(info, base_info) is False:
+                self.__logger.debug(f'adv: {getattr(source, "filename", source)}')
+                return False
 
-            os.rename(temp, target)
-            self.__logger.success('merged: %s %05d/%05d' % (target, index + 1, file_total))
-        except Exception as e:
-            self.__logger.error('failed: %s %s' % (target, e))
+            return True
 
-    async def __get_cipher(self, playlist: m3u8.M3U8):
-        encryption = playlist.keys[0]
+        return accept
 
-        if encryption is None:
+    @staticmethod
+    def __get_media_info(source) -> dict:
+        if not isinstance(source, Spool):
+            return get_media_info(source)
+
+        info = probe(source.head(PROBE_SIZE))
+        if info:
+            return info
+
+        # ffprobe needs a file
+        source.spill()
+
+        return get_media_info(source.filename)
+
+    def __get_hedger(self, total: int) -> Hedger | None:
+        # the budget is per episode: at most this share of its segments is fetched twice
+        if not self.hedge_budget:
             return None
 
-        aes_key = await self.__http.get(encryption.absolute_uri)
-        aes_iv = await self.get_aes_iv(encryption)
+        return Hedger(max(1, int(total * self.hedge_budget)))
 
-        return AES.new(aes_key, AES.MODE_CBC, aes_iv)
+    def __get_limiter(self) -> asyncio.Semaphore | None:
+        # one budget for every episode this downloader has in flight
+        if self.budget is not None and self.__limiter is None:
+            self.__limiter = asyncio.Semaphore(self.budget)
+
+        return self.__limiter
 
     @staticmethod
     async def get_aes_iv(encryption: Key) -> bytes|None:
-        if encryption.iv is None:
-            return None
-        return bytes.fromhex(encryption.iv.replace("0x", ""))
+        return get_key_iv(encryption)
 
     async def __get_playlist(self, page: Page):
         url = page.m3u8
 
         while True:
-            response = await self.__http.get(url)
+            response = await (self.__http.get(url) if self.__cache is None else self.__cache.get(url, 'playlist'))
             parsed = m3u8.loads(response.decode('utf-8'), url)
 
             if len(parsed.segments) > 0:
                 return parsed
 
-            playlist = parsed.playlists[0]
+            url = await self.__select_variant(parsed.playlists)
+
+    async def __select_variant(self, playlists: list) -> str:
+        candidates = self.variants.rank(playlists, self.controller.throughput())
+        if self.variants.probes < 1 or len(candidates) < 2:
+            return self.__get_m3u8_url(candidates[0])
+
+        rates = {}
+        for playlist in candidates[:self.variants.probes]:
             url = self.__get_m3u8_url(playlist)
+            rates[url] = await self.__probe_variant(url)
+            self.__logger.debug('variant: %s %.2f MB/s' % (url, rates[url] / 1024 / 1024))
+
+        if self.variants.policy == 'throughput' and not self.controller.throughput():
+            # nothing downloaded yet: the probes are the only measure of the link
+            return self.__get_m3u8_url(self.variants.rank(playlists, max(rates.values()))[0])
+
+        return max(rates, key=rates.get)
+
+    async def __probe_variant(self, url: str) -> float:
+        started = time.monotonic()
+        try:
+            parsed = m3u8.loads((await self.__http.get(url)).decode('utf-8'), url)
+            if len(parsed.segments) == 0:
+                return 0.0
+            size = len(await self.__http.get(parsed.segments[0].absolute_uri))
+        except (HTTPError, Exception) as e:
+            self.__logger.warning(e)
+            return 0.0
+
+        return size / max(time.monotonic() - started, 1e-6)
 
     def __get_directory(self, page: Page):
         if not os.path.exists(self.__root):
@@ -172,27 +572,11 @@ class M3U8Downloader:
             os.mkdir(root)
 
         directory = os.path.join(root, page.episode)
-        if not os.path.exists(directory):
+        if self.keep_segments and not os.path.exists(directory):
             os.mkdir(directory)
 
         return directory
 
-    def __is_files_equals(self, directory, total):
-        files = self.find_ts(directory)
-        file_total = len(files)
-
-        if file_total > total:
-            for file in files:
-                if os.path.exists(file):
-                    os.unlink(file)
-                    self.__logger.warning(f'{file} deleted')
-
-        return file_total == total
-
-    @staticmethod
-    def find_ts(directory):
-        return sorted(glob.glob(os.path.join(directory, '*.ts')))
-
     @staticmethod
     def __get_m3u8_url(playlist: Playlist):
         base_uri = playlist.base_uri
@@ -206,9 +590,13 @@ class M3U8Downloader:
         return f'{parsed.scheme}://{parsed.netloc}{uri}'
 
 
-async def main(page: Page):
-    downloader = M3U8Downloader('video')
-    await downloader.download(page)
+async def main(page: Page, profile: str = None, root: str = 'video'):
+    os.makedirs(root, exist_ok=True)
+    async with Http() as client:
+        # segment state lives next to the videos, a rerun resumes without asking the server
+        downloader = M3U8Downloader(root, client, state=StateStore(os.path.join(root, 'state.db')))
+        async with downloader, BOARD, Profiler(profile):
+            await downloader.download(page)
 
 
 if __name__ == '__main__':
@@ -1,15 +1,30 @@
 import asyncio
+import os
 from typing import Union
 
+from cache import ResponseCache
 from client import Http
-from crawlers import Factory
+from crawlers import Crawler, Factory, Page
 from m3u8_downloader import M3U8Downloader
+from metrics import Exporter
+from mirrors import MirrorProber
+from profiler import Profiler
+from progress import BOARD, ProgressBoard
+from state import StateStore
+from validator import Validator
 
 
 class Downloader:
-    def __init__(self, factory: Factory, m3u8_downloader: M3U8Downloader):
+    def __init__(self, factory: Factory, m3u8_downloader: M3U8Downloader, episodes: int = 1):
         self.factory = factory
         self.m3u8_downloader = m3u8_downloader
+        self.episodes = episodes
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.m3u8_downloader.close()
 
     async def download(
             self,
@@ -17,18 +32,99 @@ class Downloader:
             url: str,
             start: Union[int, str, None] = None,
             end: Union[int, str, None] = None
-    ):
+    ) -> dict:
+        # episode -> whether it was downloaded
         crawler = self.factory.create(url)
         pages = crawler.pages(name, url, start, end)
+        results = {}
+
+        if self.episodes <= 1:
+            async for page in pages:
+                results[page.episode] = await self.fetch(page, crawler)
+            return results
+
+        # several episodes in flight; their segments share the downloader's budget
+        semaphore = asyncio.Semaphore(self.episodes)
+        tasks = []
+        try:
+            async for page in pages:
+                await semaphore.acquire()
+                tasks.append(asyncio.ensure_future(self.__download(crawler, page, semaphore, results)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return results
+
+    async def __download(self, crawler: Crawler, page: Page, semaphore: asyncio.Semaphore, results: dict):
+        try:
+            results[page.episode] = await self.fetch(page, crawler)
+        finally:
+            semaphore.release()
+
+    async def fetch(self, page: Page, crawler: Crawler = None) -> bool:
+        if await self.m3u8_downloader.download(page):
+            return True
+
+        # the episode failed or stalled on this source, try the next fastest one
+        crawler = self.factory.create(page.url) if crawler is None else crawler
+        for url in page.mirrors:
+            try:
+                mirror = await crawler.mirror(page, url)
+            except Exception:
+                continue
+
+            if await self.m3u8_downloader.download(mirror):
+                return True
+
+        return False
+
+
+def create(
+        client: Http,
+        root: str = 'video',
+        episodes: int = 3,
+        board: ProgressBoard = None,
+        journal: str = 'WAL'
+) -> Downloader:
+    os.makedirs(root, exist_ok=True)
+    # listing pages, playlists and keys are served from disk when a series is resumed
+    cache = ResponseCache(client, os.path.join(root, '.cache'))
+    state = StateStore(os.path.join(root, 'state.db'), journal=journal)
+    m3u8_downloader = M3U8Downloader(
+        root,
+        client,
+        budget=client.limit_per_host,
+        cache=cache,
+        state=state,
+        validator=Validator(),
+        board=board
+    )
+
+    return Downloader(Factory(client, MirrorProber(client), cache), m3u8_downloader, episodes)
+
 
-        async for page in pages:
-            await self.m3u8_downloader.download(page)
+def export(root: str = 'video', port: int = None, name: str = 'metrics') -> Exporter:
+    return Exporter(
+        jsonl=os.path.join(root, name + '.jsonl'),
+        prometheus=os.path.join(root, name + '.prom'),
+        port=port
+    )
 
 
-async def main(folder: str, url: str, start: Union[int, str, None] = None, end: Union[int, str, None] = None):
-    client = Http()
-    downloader = Downloader(Factory(client), M3U8Downloader('video', client))
-    await downloader.download(folder, url, start, end)
+async def main(
+        folder: str,
+        url: str,
+        start: Union[int, str, None] = None,
+        end: Union[int, str, None] = None,
+        episodes: int = 3,
+        profile: str = None
+):
+    async with Http() as client:
+        downloader = create(client, episodes=episodes)
+        async with downloader, export(), BOARD, Profiler(profile):
+            await downloader.download(folder, url, start, end)
 
 
 if __name__ == '__main__':
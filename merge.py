@@ -0,0 +1,237 @@
+import asyncio
+import errno
+import io
+import os
+import threading
+import time
+
+from metrics import REGISTRY, Metrics
+
+BUFFER_SIZE = 1024 * 1024
+
+# errors meaning "this kernel/filesystem can't do it", anything else is a real failure
+FALLBACK_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP)
+
+
+def copy_file_range(src: int, dst: int, offset: int, count: int) -> int:
+    return os.copy_file_range(src, dst, count, offset)
+
+
+def sendfile(src: int, dst: int, offset: int, count: int) -> int:
+    return os.sendfile(dst, src, offset, count)
+
+
+BACKENDS = {
+    'copy_file_range': copy_file_range,
+    'sendfile': sendfile,
+}
+
+
+def get_backends() -> list:
+    return [name for name in BACKENDS if hasattr(os, name)]
+
+
+def is_os_file(f) -> bool:
+    return isinstance(f, (io.FileIO, io.BufferedReader, io.BufferedWriter, io.BufferedRandom))
+
+
+def write_all(fw, data: bytes):
+    # a raw file (buffering=0) may take only part of the buffer, the rest is written again
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[fw.write(view):]
+
+
+def append_file(filename: str, fw, backends: list = None, buffer_size: int = BUFFER_SIZE) -> int:
+    backends = get_backends() if backends is None else backends
+    size = os.path.getsize(filename)
+    offset = 0
+
+    with open(filename, 'rb') as fr:
+        if is_os_file(fr) and is_os_file(fw):
+            fw.flush()
+            for backend in backends:
+                try:
+                    while offset < size:
+                        copied = BACKENDS[backend](fr.fileno(), fw.fileno(), offset, size - offset)
+                        if copied == 0:
+                            break
+                        offset += copied
+                    break
+                except OSError as e:
+                    if e.errno not in FALLBACK_ERRNOS:
+                        raise
+
+        fr.seek(offset)
+        for chunk in iter(lambda: fr.read(buffer_size), b''):
+            write_all(fw, chunk)
+
+    return size
+
+
+class Spool:
+    def __init__(self, buffer, filename: str):
+        self.__buffer = buffer
+        self.filename = filename
+        self.size = 0
+        self.spilled = False
+        self.__memory = io.BytesIO()
+        self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, data: bytes):
+        if not self.spilled and not self.__buffer.reserve(len(data)):
+            self.spill()
+
+        if self.spilled:
+            if self.__file is None:
+                self.__file = open(self.filename, 'ab')
+            self.__file.write(data)
+        else:
+            self.__memory.write(data)
+        self.size += len(data)
+
+    def spill(self):
+        if self.spilled:
+            return
+
+        with open(self.filename, 'wb') as f:
+            f.write(self.__memory.getvalue())
+        self.__release()
+        self.spilled = True
+
+    def head(self, size: int) -> bytes:
+        if not self.spilled:
+            return self.__memory.getvalue()[:size]
+
+        with open(self.filename, 'rb') as f:
+            return f.read(size)
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+        self.__file = None
+
+    def append_to(self, fw):
+        self.close()
+        if self.spilled:
+            append_file(self.filename, fw)
+        else:
+            write_all(fw, self.__memory.getbuffer())
+        self.discard()
+
+    def discard(self):
+        self.close()
+        if self.spilled and os.path.exists(self.filename):
+            os.unlink(self.filename)
+        self.__release()
+
+    def __release(self):
+        self.__buffer.release(self.__memory.tell())
+        self.__memory = io.BytesIO()
+
+
+class ReorderBuffer:
+    def __init__(
+            self,
+            fw,
+            accept=None,
+            directory: str = None,
+            prefix: str = '',
+            memory_budget: int = 64 * 1024 * 1024,
+            metrics: Metrics = None
+    ):
+        self.__fw = fw
+        self.metrics = REGISTRY if metrics is None else metrics
+        self.__accept = accept
+        self.directory = directory
+        self.prefix = prefix
+        self.memory_budget = memory_budget
+        self.next = 0
+        self.__memory = 0
+        self.__memory_lock = threading.Lock()
+        self.__ready = {}
+        self.__lock = None
+
+    def open(self, index: int, suffix: str = '') -> Spool:
+        name = '.%s.%05d%s.spool' % (self.prefix, index, '.' + suffix if suffix else '')
+
+        return Spool(self, os.path.join(self.directory, name))
+
+    def reserve(self, size: int) -> bool:
+        with self.__memory_lock:
+            if self.__memory + size > self.memory_budget:
+                return False
+            self.__memory += size
+            return True
+
+    def release(self, size: int):
+        with self.__memory_lock:
+            self.__memory -= size
+
+    @property
+    def received(self) -> int:
+        return self.next + len(self.__ready)
+
+    async def add(self, index: int, source):
+        if index < self.next or index in self.__ready:
+            # both copies of a hedged segment finished, the first one is kept
+            if isinstance(source, Spool):
+                source.discard()
+            return
+
+        self.__ready[index] = source
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+
+        loop = asyncio.get_event_loop()
+        async with self.__lock:
+            while self.next in self.__ready:
+                source = self.__ready.pop(self.next)
+                started = time.monotonic()
+                position = self.__fw.tell()
+                appending = loop.run_in_executor(None, self.__append, source)
+                try:
+                    await asyncio.shield(appending)
+                except asyncio.CancelledError:
+                    # the thread keeps writing: wait for it, so the segment counts and the next one is not written early
+                    await appending
+                    self.__appended(source, position, started)
+                    raise
+                self.__appended(source, position, started)
+
+    def __appended(self, source, position: int, started: float):
+        if source is not None:
+            self.metrics.count('merge_bytes_total', self.__fw.tell() - position)
+            self.metrics.observe('merge_seconds', time.monotonic() - started)
+        self.next += 1
+
+    async def skip(self, index: int):
+        await self.add(index, None)
+
+    def discard(self):
+        for source in self.__ready.values():
+            if isinstance(source, Spool):
+                source.discard()
+        self.__ready = {}
+
+    def __append(self, source):
+        if source is None:
+            return
+
+        if not isinstance(source, Spool):
+            if self.__accept is None or self.__accept(source):
+                append_file(source, self.__fw)
+            return
+
+        if self.__accept is not None:
+            source.close()
+            if not self.__accept(source):
+                source.discard()
+                return
+        source.append_to(self.__fw)
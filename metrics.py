@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def get_key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if len(labels) == 0:
+        return ''
+
+    def escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{%s}' % ','.join('%s="%s"' % (key, escape(value)) for key, value in labels)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list:
+        total = 0
+        result = []
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((bucket, total))
+
+        return result
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.__counters = {}
+        self.__histograms = {}
+        # the merge loop reports from executor threads
+        self.__lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = get_key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = get_key(name, labels)
+        with self.__lock:
+            if key not in self.__histograms:
+                self.__histograms[key] = Histogram()
+            self.__histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def total(self, name: str) -> float:
+        with self.__lock:
+            return sum(value for (key, _), value in self.__counters.items() if key == name)
+
+    def seconds(self, name: str) -> float:
+        with self.__lock:
+            return sum(histogram.sum for (key, _), histogram in self.__histograms.items() if key == name)
+
+    def summary(self) -> dict:
+        elapsed = max(time.time() - self.started, 1e-6)
+        merge_seconds = self.seconds('merge_seconds')
+
+        return {
+            'segments_per_second': self.total('segments_total') / elapsed,
+            'bytes_per_second': self.total('segment_bytes_total') / elapsed,
+            'merge_mb_per_second': self.total('merge_bytes_total') / 1024 / 1024 / merge_seconds if merge_seconds else 0,
+        }
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.__counters.items())
+            ]
+            histograms = [
+                {'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum}
+                for (name, labels), histogram in sorted(self.__histograms.items())
+            ]
+
+        return {'time': time.time(), 'counters': counters, 'histograms': histograms, 'summary': self.summary()}
+
+    def prometheus(self) -> str:
+        lines = []
+        with self.__lock:
+            for name in sorted({name for name, _ in self.__counters}):
+                lines.append('# TYPE %s counter' % name)
+                for (key, labels), value in sorted(self.__counters.items()):
+                    if key == name:
+                        lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+            for name in sorted({name for name, _ in self.__histograms}):
+                lines.append('# TYPE %s histogram' % name)
+                for (key, labels), histogram in sorted(self.__histograms.items()):
+                    if key != name:
+                        continue
+                    for bucket, count in histogram.cumulative():
+                        lines.append('%s_bucket%s %d' % (name, format_labels(labels, (('le', str(bucket)),)), count))
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, (('le', '+Inf'),)), histogram.count))
+                    lines.append('%s_sum%s %s' % (name, format_labels(labels), histogram.sum))
+                    lines.append('%s_count%s %d' % (name, format_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Metrics()
+
+
+class Exporter:
+    def __init__(
+            self,
+            metrics: Metrics = None,
+            jsonl: str = None,
+            prometheus: str = None,
+            port: int = None,
+            interval: float = 10
+    ):
+        self.metrics = REGISTRY if metrics is None else metrics
+        self.jsonl = jsonl
+        self.prometheus = prometheus
+        self.port = port
+        self.interval = interval
+        self.__task: asyncio.Future | None = None
+        self.__runner: web.AppRunner | None = None
+
+    async def __aenter__(self):
+        if self.port is not None:
+            app = web.Application()
+            app.router.add_get('/metrics', self.__handle)
+            self.__runner = web.AppRunner(app)
+            await self.__runner.setup()
+            await web.TCPSite(self.__runner, '127.0.0.1', self.port).start()
+        self.__task = asyncio.ensure_future(self.__run())
+
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__task.cancel()
+        await asyncio.gather(self.__task, return_exceptions=True)
+        self.flush()
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    def flush(self):
+        if self.jsonl is not None:
+            with open(self.jsonl, 'a') as f:
+                f.write(json.dumps(self.metrics.snapshot(), ensure_ascii=False) + '\n')
+
+        if self.prometheus is not None:
+            # scrapers read the file at any time, never show them half of it
+            temp = self.prometheus + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(self.metrics.prometheus())
+            os.replace(temp, self.prometheus)
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    async def __handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.metrics.prometheus(), content_type='text/plain')
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+
+import m3u8
+
+from client import Http
+from variants import VariantSelector
+
+
+class Probe:
+    def __init__(self, url: str, latency: float = math.inf, throughput: float = 0.0):
+        self.url = url
+        self.latency = latency
+        self.throughput = throughput
+
+    @property
+    def ok(self) -> bool:
+        return self.throughput > 0
+
+
+class MirrorProber:
+    def __init__(self, http: Http = None, timeout: float = 15, variants: VariantSelector = None):
+        self.__http = Http() if http is None else http
+        self.timeout = timeout
+        self.variants = VariantSelector() if variants is None else variants
+
+    async def probe(self, url: str) -> Probe:
+        try:
+            return await asyncio.wait_for(self.__probe(url), self.timeout)
+        except (asyncio.TimeoutError, Exception):
+            return Probe(url)
+
+    async def rank(self, urls: list) -> list:
+        probes = await asyncio.gather(*[self.probe(url) for url in urls])
+
+        # dead mirrors last, then the fastest transfer; latency only breaks ties
+        return sorted(range(len(urls)), key=lambda i: (not probes[i].ok, -probes[i].throughput, probes[i].latency))
+
+    async def __probe(self, url: str) -> Probe:
+        started = time.monotonic()
+        playlist = m3u8.loads((await self.__http.get(url)).decode('utf-8'), url)
+        latency = time.monotonic() - started
+
+        while len(playlist.segments) == 0:
+            if len(playlist.playlists) == 0:
+                return Probe(url, latency)
+            variant = self.variants.rank(playlist.playlists)[0].absolute_uri
+            playlist = m3u8.loads((await self.__http.get(variant)).decode('utf-8'), variant)
+
+        started = time.monotonic()
+        size = len(await self.__http.get(playlist.segments[0].absolute_uri))
+
+        return Probe(url, latency, size / max(time.monotonic() - started, 1e-6))
@@ -0,0 +1,244 @@
+from __future__ import annotations
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PROBE_SIZE = 16 * 1024
+
+STREAM_TYPES = {
+    0x1b: 'h264',
+    0x24: 'hevc',
+}
+
+
+class BitReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.position = 0
+
+    def u(self, bits: int) -> int:
+        value = 0
+        for _ in range(bits):
+            byte = self.data[self.position >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.position & 7))) & 1)
+            self.position += 1
+        return value
+
+    def skip(self, bits: int):
+        self.position += bits
+
+    def ue(self) -> int:
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self) -> int:
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def unescape(nal: bytes) -> bytes:
+    return nal.replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+def find_sync(data: bytes) -> int:
+    for offset in range(min(PACKET_SIZE, len(data))):
+        if all(data[i] == SYNC_BYTE for i in range(offset, min(len(data), offset + PACKET_SIZE * 3), PACKET_SIZE)):
+            return offset
+    return -1
+
+
+def iter_packets(data: bytes):
+    offset = find_sync(data)
+    if offset < 0:
+        return
+
+    for start in range(offset, len(data) - PACKET_SIZE + 1, PACKET_SIZE):
+        packet = data[start:start + PACKET_SIZE]
+        if packet[0] != SYNC_BYTE:
+            return
+
+        pid = ((packet[1] & 0x1f) << 8) | packet[2]
+        unit_start = bool(packet[1] & 0x40)
+        adaptation = (packet[3] >> 4) & 0x3
+        payload = 4
+        if adaptation & 0x2:
+            payload += 1 + packet[4]
+        if not adaptation & 0x1 or payload >= PACKET_SIZE:
+            continue
+
+        yield pid, unit_start, packet[payload:]
+
+
+def parse_section(payload: bytes) -> bytes:
+    # pointer_field, then table header up to section_length; trailing CRC is dropped
+    section = payload[1 + payload[0]:]
+    length = ((section[1] & 0x0f) << 8) | section[2]
+
+    return section[8:3 + length - 4]
+
+
+def parse_pat(payload: bytes) -> list:
+    programs = parse_section(payload)
+
+    return [
+        ((programs[i + 2] & 0x1f) << 8) | programs[i + 3]
+        for i in range(0, len(programs) - 3, 4)
+        if (programs[i] << 8) | programs[i + 1] != 0
+    ]
+
+
+def parse_pmt(payload: bytes) -> dict:
+    section = parse_section(payload)
+    info_length = ((section[2] & 0x0f) << 8) | section[3]
+    streams = {}
+    offset = 4 + info_length
+    while offset + 5 <= len(section):
+        stream_type = section[offset]
+        pid = ((section[offset + 1] & 0x1f) << 8) | section[offset + 2]
+        streams[pid] = stream_type
+        offset += 5 + (((section[offset + 3] & 0x0f) << 8) | section[offset + 4])
+
+    return streams
+
+
+def iter_nals(data: bytes):
+    start = data.find(b'\x00\x00\x01')
+    while start >= 0:
+        end = data.find(b'\x00\x00\x01', start + 3)
+        yield data[start + 3:len(data) if end < 0 else end].rstrip(b'\x00')
+        start = end
+
+
+def parse_h264_sps(nal: bytes) -> dict:
+    reader = BitReader(unescape(nal[1:]))
+    profile_idc = reader.u(8)
+    reader.skip(16)
+    reader.ue()
+
+    chroma_format_idc = 1
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = reader.ue()
+        if chroma_format_idc == 3:
+            reader.skip(1)
+        reader.ue()
+        reader.ue()
+        reader.skip(1)
+        if reader.u(1):
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if reader.u(1):
+                    last, scale = 8, 8
+                    for _ in range(16 if i < 6 else 64):
+                        if scale != 0:
+                            scale = (last + reader.se() + 256) % 256
+                        last = last if scale == 0 else scale
+
+    reader.ue()
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()
+    elif pic_order_cnt_type == 1:
+        reader.skip(1)
+        reader.se()
+        reader.se()
+        for _ in range(reader.ue()):
+            reader.se()
+
+    reader.ue()
+    reader.skip(1)
+    width_in_mbs = reader.ue() + 1
+    height_in_map_units = reader.ue() + 1
+    frame_mbs_only = reader.u(1)
+    if not frame_mbs_only:
+        reader.skip(1)
+    reader.skip(1)
+
+    crop = (0, 0, 0, 0)
+    if reader.u(1):
+        crop = (reader.ue(), reader.ue(), reader.ue(), reader.ue())
+
+    crop_x = 1 if chroma_format_idc in (0, 3) else 2
+    crop_y = (2 - frame_mbs_only) * (2 if chroma_format_idc == 1 else 1)
+
+    return {
+        'codec_name': 'h264',
+        'width': width_in_mbs * 16 - crop_x * (crop[0] + crop[1]),
+        'height': (2 - frame_mbs_only) * height_in_map_units * 16 - crop_y * (crop[2] + crop[3]),
+    }
+
+
+def parse_hevc_sps(nal: bytes) -> dict:
+    reader = BitReader(unescape(nal[2:]))
+    reader.skip(4)
+    max_sub_layers = reader.u(3)
+    reader.skip(1)
+
+    # profile_tier_level: general profile (88 bits) + level (8 bits), then optional sub-layers
+    reader.skip(96)
+    sub_layers = [(reader.u(1), reader.u(1)) for _ in range(max_sub_layers)]
+    if max_sub_layers > 0:
+        reader.skip(2 * (8 - max_sub_layers))
+    for profile_present, level_present in sub_layers:
+        reader.skip(88 * profile_present + 8 * level_present)
+
+    reader.ue()
+    chroma_format_idc = reader.ue()
+    if chroma_format_idc == 3:
+        reader.skip(1)
+    width = reader.ue()
+    height = reader.ue()
+
+    if reader.u(1):
+        sub_width = 2 if chroma_format_idc in (1, 2) else 1
+        sub_height = 2 if chroma_format_idc == 1 else 1
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        width -= sub_width * (left + right)
+        height -= sub_height * (top + bottom)
+
+    return {'codec_name': 'hevc', 'width': width, 'height': height}
+
+
+def parse_sps(codec: str, es: bytes) -> dict:
+    for nal in iter_nals(es):
+        if len(nal) < 4:
+            continue
+
+        if codec == 'h264' and nal[0] & 0x1f == 7:
+            return parse_h264_sps(nal)
+        if codec == 'hevc' and (nal[0] >> 1) & 0x3f == 33:
+            return parse_hevc_sps(nal)
+
+    return {}
+
+
+def probe(data: bytes) -> dict:
+    pmt_pids = []
+    streams = {}
+    video_pid = None
+    es = bytearray()
+
+    try:
+        for pid, unit_start, payload in iter_packets(data):
+            if pid == 0 and unit_start and not pmt_pids:
+                pmt_pids = parse_pat(payload)
+            elif pid in pmt_pids and unit_start and not streams:
+                streams = parse_pmt(payload)
+                video_pid = next((stream for stream, kind in streams.items() if kind in STREAM_TYPES), None)
+            elif pid == video_pid:
+                if unit_start and payload[:3] == b'\x00\x00\x01':
+                    # skip the PES header
+                    payload = payload[9 + payload[8]:]
+                es += payload
+
+        if video_pid is None:
+            return {}
+
+        return parse_sps(STREAM_TYPES[streams[video_pid]], bytes(es))
+    except IndexError:
+        # truncated or not a transport stream
+        return {}
+
+
+def probe_file(file: str, size: int = PROBE_SIZE) -> dict:
+    with open(file, 'rb') as f:
+        return probe(f.read(size))
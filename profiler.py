@@ -0,0 +1,265 @@
+from __future__ import annotations
+
+import asyncio
+import cProfile
+import io
+import itertools
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.durations = {}
+        self.__ids = itertools.count(1)
+        self.__origin = time.perf_counter()
+        self.__lock = threading.Lock()
+
+    def start(self):
+        self.events = []
+        self.durations = {}
+        self.__origin = time.perf_counter()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    def complete(self, name: str, category: str, started: float, ended: float, **args):
+        # a span that ran on the current thread from start to end, e.g. inside an executor
+        if not self.enabled:
+            return
+
+        self.__add({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': self.__micros(started),
+            'dur': (ended - started) * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        }, (category, name), ended - started)
+
+    def begin(self, name: str, category: str, **args) -> int | None:
+        # an async span: it may interleave with others on the event loop thread
+        if not self.enabled:
+            return None
+
+        span = next(self.__ids)
+        self.__add(self.__async_event('b', span, name, category, args))
+
+        return span
+
+    def end(self, span: int | None, name: str, category: str, started: float = None, **args):
+        if span is None or not self.enabled:
+            return
+
+        event = self.__async_event('e', span, name, category, args)
+        if started is None:
+            self.__add(event)
+        else:
+            self.__add(event, (category, name), time.perf_counter() - started)
+
+    @contextmanager
+    def span(self, name: str, category: str = '', **args):
+        if not self.enabled:
+            yield
+            return
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, category, started, time.perf_counter(), **args)
+
+    @contextmanager
+    def task_span(self, name: str, category: str = '', **args):
+        started = time.perf_counter()
+        span = self.begin(name, category, **args)
+        try:
+            yield
+        finally:
+            self.end(span, name, category, started)
+
+    def chrome(self) -> dict:
+        with self.__lock:
+            events = list(self.events)
+
+        threads = {(event['pid'], event['tid']) for event in events}
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': names.get(tid, str(tid))}}
+            for pid, tid in sorted(threads)
+        ]
+
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}
+
+    def summary(self) -> list:
+        with self.__lock:
+            durations = {key: list(values) for key, values in self.durations.items()}
+
+        rows = [
+            (category, name, len(values), sum(values), max(values))
+            for (category, name), values in durations.items()
+        ]
+
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def __async_event(self, phase: str, span: int, name: str, category: str, args: dict) -> dict:
+        return {
+            'name': name,
+            'cat': category,
+            'ph': phase,
+            'id': span,
+            'ts': self.__micros(time.perf_counter()),
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': args,
+        }
+
+    def __add(self, event: dict, key: tuple = None, seconds: float = 0):
+        with self.__lock:
+            self.events.append(event)
+            if key is not None:
+                self.durations.setdefault(key, []).append(seconds)
+
+    def __micros(self, moment: float) -> float:
+        return (moment - self.__origin) * 1e6
+
+
+TRACER = Tracer()
+
+
+class SlowCallbacks(logging.Handler):
+    def __init__(self, tracer: Tracer):
+        super().__init__(logging.WARNING)
+        self.tracer = tracer
+
+    def emit(self, record: logging.LogRecord):
+        # asyncio debug mode: "Executing <handle> took 0.123 seconds"
+        if not str(record.msg).startswith('Executing') or len(record.args or ()) != 2:
+            return
+
+        handle, seconds = record.args
+        ended = time.perf_counter()
+        self.tracer.complete('slow callback', 'asyncio', ended - seconds, ended, callback=str(handle))
+
+
+class Profiler:
+    def __init__(self, directory: str = None, slow_callback: float = 0.05, tracer: Tracer = None, top: int = 40):
+        # without a directory the profiler does nothing, so callers can always wrap their run in it
+        self.directory = directory
+        self.slow_callback = slow_callback
+        self.tracer = TRACER if tracer is None else tracer
+        self.top = top
+        self.__profile = cProfile.Profile()
+        self.__handler = SlowCallbacks(self.tracer)
+        self.__loop: asyncio.AbstractEventLoop | None = None
+        self.__restore = None
+
+    async def __aenter__(self):
+        if self.directory is None:
+            return self
+
+        loop = self.__loop = asyncio.get_running_loop()
+        self.__restore = (loop.get_debug(), loop.slow_callback_duration, loop.get_task_factory())
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.slow_callback
+        loop.set_task_factory(self.__create_task)
+        loop.run_in_executor = self.__trace_executor(loop.run_in_executor)
+        logging.getLogger('asyncio').addHandler(self.__handler)
+
+        self.tracer.start()
+        self.__profile.enable()
+
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.directory is None:
+            return
+
+        self.__profile.disable()
+        self.tracer.stop()
+
+        loop = self.__loop
+        debug, slow_callback, factory = self.__restore
+        logging.getLogger('asyncio').removeHandler(self.__handler)
+        del loop.run_in_executor
+        loop.set_task_factory(factory)
+        loop.slow_callback_duration = slow_callback
+        loop.set_debug(debug)
+
+        self.write()
+
+    def write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'trace.json'), 'w') as f:
+            json.dump(self.tracer.chrome(), f)
+        self.__profile.dump_stats(os.path.join(self.directory, 'profile.pstats'))
+        with open(os.path.join(self.directory, 'profile.txt'), 'w', encoding='utf-8') as f:
+            f.write(self.report())
+
+    def report(self) -> str:
+        lines = ['%-10s %-50s %8s %10s %10s %10s' % ('category', 'span', 'count', 'total s', 'mean ms', 'max ms')]
+        for category, name, count, total, longest in self.tracer.summary():
+            lines.append('%-10s %-50s %8d %10.3f %10.1f %10.1f' % (
+                category, name[-50:], count, total, total / count * 1000, longest * 1000
+            ))
+
+        slow = sorted(
+            (event for event in self.tracer.events if event['cat'] == 'asyncio'),
+            key=lambda event: event['dur'],
+            reverse=True
+        )
+        lines.append('')
+        lines.append('slowest callbacks')
+        for event in slow[:self.top]:
+            lines.append('%10.1f ms  %s' % (event['dur'] / 1000, event['args']['callback']))
+
+        stream = io.StringIO()
+        pstats.Stats(self.__profile, stream=stream).sort_stats('cumulative').print_stats(self.top)
+        lines.append('')
+        lines.append(stream.getvalue())
+
+        return '\n'.join(lines)
+
+    def __create_task(self, loop: asyncio.AbstractEventLoop, coro, **kwargs) -> asyncio.Task:
+        factory = self.__restore[2]
+        task = asyncio.Task(coro, loop=loop, **kwargs) if factory is None else factory(loop, coro, **kwargs)
+        name = getattr(coro, '__qualname__', type(coro).__name__)
+        started = time.perf_counter()
+        span = self.tracer.begin(name, 'task')
+        task.add_done_callback(
+            lambda done: self.tracer.end(span, name, 'task', started, cancelled=done.cancelled())
+        )
+
+        return task
+
+    def __trace_executor(self, run_in_executor):
+        def run(executor, func, *args):
+            name = getattr(func, '__qualname__', None) or getattr(getattr(func, 'func', None), '__qualname__', repr(func))
+            if not isinstance(executor, ProcessPoolExecutor):
+                return run_in_executor(executor, partial(self.__in_thread, name, func), *args)
+
+            # a process pool only pickles plain functions, it is timed from this side
+            started = time.perf_counter()
+            span = self.tracer.begin(name, 'process')
+            future = run_in_executor(executor, func, *args)
+            future.add_done_callback(lambda done: self.tracer.end(span, name, 'process', started))
+
+            return future
+
+        return run
+
+    def __in_thread(self, name: str, func, *args):
+        with self.tracer.span(name, 'executor'):
+            return func(*args)
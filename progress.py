@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import asyncio
+import sys
+import threading
+import time
+
+from utils import ANSI, Logger
+
+
+def format_bar(size: int, total: int, width: int = 20) -> str:
+    filled = int(size * width / total) if total > 0 else 0
+
+    return '█' * filled + ' ' * (width - filled)
+
+
+def format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+
+    return '%.1f GB' % size
+
+
+def format_eta(seconds: float | None) -> str:
+    if seconds is None:
+        return '--:--'
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return '%d:%02d:%02d' % (hours, minutes, seconds) if hours else '%02d:%02d' % (minutes, seconds)
+
+
+class Entry:
+    def __init__(self, title: str, total: int = 0):
+        self.title = title
+        self.total = total
+        self.done = 0
+        self.merged = 0
+        self.size = 0
+        self.started = time.monotonic()
+        self.rate = 0.0
+        self.color = None
+        self.__sampled = (self.started, 0)
+
+    def sample(self, now: float, smoothing: float = 0.3) -> float:
+        # a moving average, one slow segment does not make the ETA jump
+        sampled, size = self.__sampled
+        if now - sampled > 0:
+            rate = (self.size - size) / (now - sampled)
+            self.rate = rate if self.rate == 0 else self.rate + smoothing * (rate - self.rate)
+            self.__sampled = (now, self.size)
+
+        return self.rate
+
+    def eta(self, now: float) -> float | None:
+        if self.done == 0 or self.total <= self.done:
+            return None
+
+        return (now - self.started) / self.done * (self.total - self.done)
+
+    def line(self, now: float) -> str:
+        message = '[%s]:[%s]%6.2f%% %05d/%05d %s/s ETA %s' % (
+            self.title,
+            format_bar(self.merged, self.total),
+            self.merged / self.total * 100 if self.total > 0 else 0,
+            self.done,
+            self.total,
+            format_size(self.rate),
+            format_eta(self.eta(now))
+        )
+
+        return message if self.color is None else '%s%s%s' % (self.color, message, ANSI.end)
+
+
+class ProgressBoard:
+    def __init__(self, stream=None, interval: float = 0.1, summary_interval: float = 30, tty: bool = None):
+        self.stream = sys.stdout if stream is None else stream
+        self.tty = self.stream.isatty() if tty is None else tty
+        # a terminal is redrawn in place, a log file gets a summary now and then
+        self.interval = interval if self.tty else summary_interval
+        self.__entries = {}
+        self.__drawn = 0
+        self.__task: asyncio.Future | None = None
+        # log lines also come from executor threads, e.g. the merge's probe
+        self.__lock = threading.Lock()
+
+    def start(self, key, title: str, total: int = 0):
+        self.__entries[key] = Entry(title, total)
+
+    def update(self, key, **values):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return
+
+        for name, value in values.items():
+            setattr(entry, name, value)
+
+    def advance(self, key, done: int = 0, size: int = 0):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return
+
+        entry.done += done
+        entry.size += size
+
+    def finish(self, key):
+        self.__entries.pop(key, None)
+
+    def lines(self) -> list:
+        now = time.monotonic()
+
+        return [entry.line(now) for entry in list(self.__entries.values())]
+
+    def summary(self) -> str:
+        now = time.monotonic()
+        entries = list(self.__entries.values())
+        rate = sum(entry.sample(now) for entry in entries)
+        parts = ['%s %d/%d' % (entry.title, entry.done, entry.total) for entry in entries]
+
+        return 'progress: %d active, %s/s; %s' % (len(entries), format_size(rate), ', '.join(parts))
+
+    def write(self, message: str):
+        # log lines go above the board, which is drawn again below them
+        with self.__lock:
+            self.__clear()
+            self.stream.write(message + '\n')
+            self.__draw()
+
+    def render(self):
+        if not self.tty:
+            if len(self.__entries) > 0:
+                with self.__lock:
+                    self.stream.write(self.summary() + '\n')
+                    self.stream.flush()
+            return
+
+        now = time.monotonic()
+        for entry in list(self.__entries.values()):
+            entry.sample(now)
+        with self.__lock:
+            self.__clear()
+            self.__draw()
+
+    async def __aenter__(self):
+        if self.tty:
+            Logger.writer = self.write
+        self.__task = asyncio.ensure_future(self.__run())
+
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__task.cancel()
+        await asyncio.gather(self.__task, return_exceptions=True)
+        self.__task = None
+        self.render()
+        if Logger.writer == self.write:
+            Logger.writer = None
+        self.__drawn = 0
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.render()
+
+    def __clear(self):
+        if self.__drawn > 0:
+            # back to the first line of the board and erase down to the end of the screen
+            self.stream.write('\033[%dF\033[J' % self.__drawn)
+        self.__drawn = 0
+
+    def __draw(self):
+        if self.__task is None:
+            self.stream.flush()
+            return
+
+        lines = self.lines()
+        for line in lines:
+            self.stream.write(line + '\n')
+        self.__drawn = len(lines)
+        self.stream.flush()
+
+
+BOARD = ProgressBoard()
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import statistics
+import time
+from typing import Awaitable, Callable
+
+
+class Progress:
+    def __init__(self):
+        self.started: float | None = None
+        self.size = 0
+
+    def start(self):
+        # called once the transfer holds its connection slot, time spent queued is not the server's
+        self.started = time.monotonic()
+        self.size = 0
+
+    @property
+    def elapsed(self) -> float:
+        return 0 if self.started is None else time.monotonic() - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.size / max(self.elapsed, 1e-6)
+
+
+class Hedger:
+    def __init__(
+            self,
+            budget: int = 8,
+            percentile: float = 0.95,
+            slowdown: float = 0.2,
+            samples: int = 10,
+            interval: float = 0.5
+    ):
+        self.budget = budget
+        self.percentile = percentile
+        self.slowdown = slowdown
+        self.samples = samples
+        self.interval = interval
+        self.hedged = 0
+        self.won = 0
+        self.__durations = []
+        self.__rates = []
+
+    def record(self, progress: Progress):
+        if progress.started is None:
+            # nothing was transferred, e.g. the segment was already on disk
+            return
+
+        self.__durations.append(progress.elapsed)
+        self.__rates.append(progress.rate)
+
+    def should_hedge(self, progress: Progress) -> bool:
+        if self.hedged >= self.budget or len(self.__durations) < self.samples or progress.started is None:
+            return False
+
+        durations = sorted(self.__durations)
+        if progress.elapsed > durations[min(len(durations) - 1, int(len(durations) * self.percentile))]:
+            return True
+
+        # give the transfer a median segment's worth of time before judging its rate
+        if progress.elapsed < statistics.median(durations):
+            return False
+
+        return progress.rate < statistics.median(self.__rates) * self.slowdown
+
+
+class Scheduler:
+    def __init__(self, concurrency: int = 10, limiter: asyncio.Semaphore = None, hedger: Hedger = None):
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.hedger = hedger
+        self.__queue: asyncio.PriorityQueue | None = None
+        self.__counter = itertools.count()
+        self.__pending = []
+        self.__failed: asyncio.Event | None = None
+        self.__error: BaseException | None = None
+
+    def submit(
+            self,
+            priority: int,
+            job: Callable[..., Awaitable],
+            hedge: Callable[[Progress], Awaitable] = None,
+            then: Callable[..., Awaitable] = None
+    ):
+        # hedged jobs are handed a Progress to report their transferred bytes on;
+        # then gets the winning copy's result and is never cancelled by the race
+        self.__pending.append((priority, next(self.__counter), job, hedge, then))
+
+    def cancel(self, error: BaseException = None):
+        if self.__error is None:
+            self.__error = asyncio.CancelledError() if error is None else error
+        if self.__failed is not None:
+            self.__failed.set()
+
+    async def join(self):
+        self.__queue = asyncio.PriorityQueue()
+        self.__failed = asyncio.Event()
+        for item in self.__pending:
+            self.__queue.put_nowait(item)
+        self.__pending = []
+
+        size = min(self.concurrency, self.__queue.qsize())
+        consumers = [asyncio.ensure_future(self.__consume()) for _ in range(size)]
+        done = asyncio.ensure_future(self.__queue.join())
+        failed = asyncio.ensure_future(self.__failed.wait())
+        try:
+            await asyncio.wait([done, failed], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in consumers + [done, failed]:
+                task.cancel()
+            await asyncio.gather(*consumers, done, failed, return_exceptions=True)
+
+        if self.__error is not None:
+            raise self.__error
+
+    async def __consume(self):
+        while True:
+            _, _, job, hedge, then = await self.__queue.get()
+            try:
+                if self.limiter is None:
+                    result = await self.__run(job, hedge)
+                else:
+                    async with self.limiter:
+                        result = await self.__run(job, hedge)
+                if then is not None:
+                    await then(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.cancel(e)
+            finally:
+                self.__queue.task_done()
+
+    async def __run(self, job: Callable[..., Awaitable], hedge: Callable[[Progress], Awaitable] | None):
+        if self.hedger is None or hedge is None:
+            return await (job() if hedge is None else job(Progress()))
+
+        progress = Progress()
+        tasks = {asyncio.ensure_future(job(progress)): progress}
+        try:
+            while True:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedger.interval, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # a failed copy only matters when there is no other one left to wait for
+                    if task.exception() is not None and len(tasks) > 1:
+                        del tasks[task]
+                        continue
+
+                    result = task.result()
+                    self.hedger.record(tasks[task])
+                    if tasks[task] is not progress:
+                        self.hedger.won += 1
+                    return result
+
+                if len(tasks) == 1 and progress in tasks.values() and self.hedger.should_hedge(progress):
+                    self.hedger.hedged += 1
+                    backup = Progress()
+                    tasks[asyncio.ensure_future(hedge(backup))] = backup
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
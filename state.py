@@ -0,0 +1,317 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from utils import checksum
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS episodes (
+    id INTEGER PRIMARY KEY,
+    series_id INTEGER NOT NULL REFERENCES series (id),
+    episode TEXT NOT NULL,
+    url TEXT,
+    m3u8 TEXT,
+    total INTEGER,
+    target TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    UNIQUE (series_id, episode)
+);
+CREATE TABLE IF NOT EXISTS segments (
+    episode_id INTEGER NOT NULL REFERENCES episodes (id),
+    idx INTEGER NOT NULL,
+    uri TEXT,
+    key_uri TEXT,
+    filename TEXT,
+    size INTEGER,
+    checksum TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease REAL,
+    PRIMARY KEY (episode_id, idx)
+);
+CREATE INDEX IF NOT EXISTS segments_status ON segments (episode_id, status);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    spec TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    owner TEXT,
+    lease REAL,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    episode TEXT NOT NULL,
+    url TEXT,
+    m3u8 TEXT,
+    mirrors TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (name, episode)
+);
+CREATE INDEX IF NOT EXISTS queue_status ON queue (status, lease);
+'''
+
+
+def is_alive(owner: str) -> bool:
+    # only a process on this host can be looked up, any other owner is trusted until its lease runs out
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit() or os.name == 'nt':
+        return True
+
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class StateStore:
+    def __init__(
+            self,
+            filename: str = ':memory:',
+            owner: str = None,
+            lease: float = 300,
+            timeout: float = 30,
+            journal: str = 'WAL'
+    ):
+        self.filename = filename
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid()) if owner is None else owner
+        self.lease = lease
+        # autocommit: every write below is its own transaction, or an explicit BEGIN IMMEDIATE one
+        # segments are claimed and completed from executor threads, the lock keeps them off each other's statements
+        self.__lock = threading.RLock()
+        self.__connection = sqlite3.connect(filename, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.__connection.row_factory = sqlite3.Row
+        if filename != ':memory:':
+            # WAL needs shared memory, it only works for processes on one host; a network share needs DELETE
+            self.__connection.execute('PRAGMA journal_mode=%s' % journal)
+        self.__connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def episode(self, name: str, episode: str, url: str = None, m3u8: str = None) -> int:
+        with self.__transaction() as db:
+            db.execute('INSERT OR IGNORE INTO series (name) VALUES (?)', (name,))
+            series_id = db.execute('SELECT id FROM series WHERE name = ?', (name,)).fetchone()['id']
+            db.execute(
+                'INSERT INTO episodes (series_id, episode, url, m3u8) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (series_id, episode) DO UPDATE SET url = excluded.url, m3u8 = excluded.m3u8',
+                (series_id, episode, url, m3u8)
+            )
+
+            return db.execute(
+                'SELECT id FROM episodes WHERE series_id = ? AND episode = ?', (series_id, episode)
+            ).fetchone()['id']
+
+    def start(self, episode_id: int, total: int) -> list:
+        # segments past the end belong to an older playlist; their files are returned for removal
+        with self.__transaction() as db:
+            stale = db.execute(
+                'SELECT filename FROM segments WHERE episode_id = ? AND idx >= ? AND filename IS NOT NULL',
+                (episode_id, total)
+            ).fetchall()
+            db.execute('DELETE FROM segments WHERE episode_id = ? AND idx >= ?', (episode_id, total))
+            db.execute("UPDATE episodes SET total = ?, status = 'downloading' WHERE id = ?", (total, episode_id))
+
+        return [row['filename'] for row in stale]
+
+    def finish(self, episode_id: int, target: str, status: str = 'merged'):
+        with self.__lock:
+            self.__connection.execute(
+                'UPDATE episodes SET target = ?, status = ? WHERE id = ?', (target, status, episode_id)
+            )
+
+    def status(self, episode_id: int) -> str | None:
+        with self.__lock:
+            row = self.__connection.execute('SELECT status FROM episodes WHERE id = ?', (episode_id,)).fetchone()
+
+        return None if row is None else row['status']
+
+    def segment(self, episode_id: int, index: int) -> dict | None:
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT * FROM segments WHERE episode_id = ? AND idx = ?', (episode_id, index)
+            ).fetchone()
+
+        return None if row is None else dict(row)
+
+    def count(self, episode_id: int, status: str = 'done') -> int:
+        with self.__lock:
+            return self.__connection.execute(
+                'SELECT COUNT(*) FROM segments WHERE episode_id = ? AND status = ?', (episode_id, status)
+            ).fetchone()[0]
+
+    def is_complete(self, episode_id: int, index: int, filename: str, uri: str = None) -> bool:
+        segment = self.segment(episode_id, index)
+        if segment is None or segment['status'] != 'done' or not os.path.exists(filename):
+            return False
+
+        if uri is not None and segment['uri'] != uri:
+            return False
+
+        return os.path.getsize(filename) == segment['size']
+
+    def complete(self, episode_id: int, index: int, filename: str, uri: str = None, key_uri: str = None):
+        size, digest = os.path.getsize(filename), checksum(filename)
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT INTO segments (episode_id, idx, uri, key_uri, filename, size, checksum, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 'done') "
+                "ON CONFLICT (episode_id, idx) DO UPDATE SET uri = excluded.uri, key_uri = excluded.key_uri, "
+                "filename = excluded.filename, size = excluded.size, checksum = excluded.checksum, "
+                "status = 'done', owner = NULL, lease = NULL",
+                (episode_id, index, uri, key_uri, filename, size, digest)
+            )
+
+    def claim(self, episode_id: int, index: int) -> bool:
+        # one process fetches a segment at a time; a lease that ran out can be taken over
+        now = time.time()
+        with self.__transaction() as db:
+            db.execute('INSERT OR IGNORE INTO segments (episode_id, idx) VALUES (?, ?)', (episode_id, index))
+            claimed = db.execute(
+                "UPDATE segments SET status = 'running', owner = ?, lease = ? "
+                "WHERE episode_id = ? AND idx = ? AND status != 'done' "
+                "AND (owner IS NULL OR owner = ? OR lease < ?)",
+                (self.owner, now + self.lease, episode_id, index, self.owner, now)
+            ).rowcount
+
+        return claimed > 0
+
+    def release(self, episode_id: int, index: int, status: str = 'failed'):
+        with self.__lock:
+            self.__connection.execute(
+                "UPDATE segments SET status = ?, owner = NULL, lease = NULL "
+                "WHERE episode_id = ? AND idx = ? AND owner = ? AND status != 'done'",
+                (status, episode_id, index, self.owner)
+            )
+
+    def job(self, job_id: str) -> dict | None:
+        with self.__lock:
+            row = self.__connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+        return None if row is None else dict(row)
+
+    def claim_job(self, job_id: str, spec: str) -> bool:
+        # a running job is taken over when its lease ran out or its owner was killed on this host
+        now = time.time()
+        with self.__transaction() as db:
+            db.execute('INSERT OR IGNORE INTO jobs (id, spec, updated) VALUES (?, ?, ?)', (job_id, spec, now))
+            job = db.execute('SELECT status, owner, lease FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if job['status'] == 'done':
+                return False
+            if job['status'] == 'running' and job['owner'] != self.owner and job['lease'] >= now \
+                    and is_alive(job['owner']):
+                return False
+
+            db.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, lease = ?, updated = ? WHERE id = ?",
+                (self.owner, now + self.lease, now, job_id)
+            )
+
+        return True
+
+    def finish_job(self, job_id: str, status: str = 'done', error: str = None):
+        with self.__lock:
+            self.__connection.execute(
+                'UPDATE jobs SET status = ?, error = ?, owner = NULL, lease = NULL, updated = ? WHERE id = ?',
+                (status, error, time.time(), job_id)
+            )
+
+    def enqueue(self, name: str, episode: str, url: str, m3u8: str, mirrors: list = None) -> bool:
+        with self.__lock:
+            return self.__connection.execute(
+                'INSERT OR IGNORE INTO queue (name, episode, url, m3u8, mirrors) VALUES (?, ?, ?, ?, ?)',
+                (name, episode, url, m3u8, json.dumps([] if mirrors is None else mirrors))
+            ).rowcount > 0
+
+    def claim_episode(self) -> dict | None:
+        # pending work first, then work whose owner stopped sending heartbeats
+        now = time.time()
+        with self.__transaction() as db:
+            row = db.execute(
+                "SELECT * FROM queue WHERE status = 'pending' OR (status = 'running' AND lease < ?) "
+                "ORDER BY status = 'running', id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            db.execute(
+                "UPDATE queue SET status = 'running', owner = ?, lease = ?, attempts = attempts + 1 WHERE id = ?",
+                (self.owner, now + self.lease, row['id'])
+            )
+
+        entry = dict(row)
+        entry['mirrors'] = json.loads(entry['mirrors'] or '[]')
+        entry['attempts'] += 1
+
+        return entry
+
+    def finish_episode(self, entry_id: int, status: str = 'done') -> bool:
+        # a worker whose lease was taken over must not overwrite the new owner's result
+        with self.__lock:
+            return self.__connection.execute(
+                'UPDATE queue SET status = ?, owner = NULL, lease = NULL WHERE id = ? AND owner = ?',
+                (status, entry_id, self.owner)
+            ).rowcount > 0
+
+    def remaining(self) -> int:
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT COUNT(*) FROM queue WHERE status IN ('pending', 'running')"
+            ).fetchone()[0]
+
+    def queued(self, status: str) -> list:
+        with self.__lock:
+            return [dict(row) for row in self.__connection.execute(
+                'SELECT * FROM queue WHERE status = ? ORDER BY id', (status,)
+            )]
+
+    def heartbeat(self):
+        lease = time.time() + self.lease
+        with self.__transaction() as db:
+            for table in ('queue', 'jobs', 'segments'):
+                db.execute('UPDATE %s SET lease = ? WHERE owner = ?' % table, (lease, self.owner))
+
+    def __transaction(self):
+        return Transaction(self.__connection, self.__lock)
+
+
+class Transaction:
+    def __init__(self, connection: sqlite3.Connection, lock: threading.RLock):
+        self.connection = connection
+        self.lock = lock
+
+    def __enter__(self) -> sqlite3.Connection:
+        # take the write lock up front, so a read-then-write cannot interleave with another process
+        self.lock.acquire()
+        try:
+            self.connection.execute('BEGIN IMMEDIATE')
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.connection.execute('ROLLBACK' if exc_type is not None else 'COMMIT')
+        finally:
+            self.lock.release()
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from mpegts import PACKET_SIZE
+
+NULL_PACKET = b'\x47\x1f\xff\x10' + b'\xff' * 184
+
+
+def ue(value: int) -> str:
+    bits = bin(value + 1)[2:]
+    return '0' * (len(bits) - 1) + bits
+
+
+def rbsp(bits: str) -> bytes:
+    bits += '1'
+    bits += '0' * (-len(bits) % 8)
+    data = bytes(int(bits[i:i + 8], 2) for i in range(0, len(bits), 8))
+    escaped = bytearray()
+    for byte in data:
+        if len(escaped) >= 2 and escaped[-2:] == b'\x00\x00' and byte <= 3:
+            escaped.append(3)
+        escaped.append(byte)
+    return bytes(escaped)
+
+
+def h264_sps(width: int, height: int) -> bytes:
+    bits = '01100100' + '0' * 8 + '00101000' + ue(0) + ue(1) + ue(0) + ue(0) + '0' + '0'
+    bits += ue(0) + ue(0) + ue(0) + ue(4) + '0'
+    bits += ue((width + 15) // 16 - 1) + ue((height + 15) // 16 - 1) + '1' + '1'
+    bits += '1' + ue(0) + ue(0) + ue(0) + ue((-height % 16) // 2) + '0'
+    return b'\x67' + rbsp(bits)
+
+
+def hevc_sps(width: int, height: int) -> bytes:
+    bits = '0000' + '000' + '1' + '0' * 96 + ue(0) + ue(1) + ue(width) + ue(height + -height % 8)
+    bits += '1' + ue(0) + ue(0) + ue(0) + ue((-height % 8) // 2)
+    return b'\x42\x01' + rbsp(bits)
+
+
+def make_ts(stream_type: int, sps: bytes, size: int = 0) -> bytes:
+    # PAT, PMT and a keyframe that can be probed, padded with null packets up to size
+    def packet(pid: int, payload: bytes, unit_start: bool = True, counter: int = 0):
+        header = bytes([0x47, (0x40 if unit_start else 0) | (pid >> 8), pid & 0xff, 0x10 | counter % 16])
+        return header + payload + b'\xff' * (184 - len(payload))
+
+    def section(table_id: int, body: bytes):
+        length = len(body) + 5 + 4
+        return b'\x00' + bytes([table_id, 0xb0 | (length >> 8), length & 0xff, 0, 1, 0xc1, 0, 0]) + body + b'\x00' * 4
+
+    pat = section(0x00, b'\x00\x01\xf0\x00')
+    pmt = section(0x02, b'\xe1\x00\xf0\x00' + bytes([stream_type]) + b'\xe1\x00\xf0\x00')
+    es = b'\x00\x00\x00\x01' + sps + b'\x00\x00\x00\x01' + b'\x65' + b'\x88' * 400
+    pes = b'\x00\x00\x01\xe0\x00\x00\x80\x00\x00' + es
+    video = [packet(0x100, pes[i:i + 184], i == 0, i // 184) for i in range(0, len(pes), 184)]
+    data = packet(0, pat) + packet(0x1000, pmt) + b''.join(video)
+
+    return data + NULL_PACKET * max(0, (size - len(data)) // PACKET_SIZE)
@@ -1,27 +1,84 @@
+import asyncio
 import glob
+import hashlib
 import io
+import json
 import os
 import re
-from unittest.mock import MagicMock, patch
-
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import aiohttp
 import m3u8
 import pytest
+import pytest_asyncio
 from Cryptodome.Cipher import AES
+from Cryptodome.Random import get_random_bytes
 from Cryptodome.Util.Padding import pad
 from pyfakefs.fake_filesystem import FakeFilesystem
 from pytest_mock import MockFixture
 
+from ads import AdDetector
+from batch import BatchRunner, Job, read_jobs
+from cache import ResponseCache
 from client import Http
+from congestion import Backoff, CongestionController
 from crawlers import Page, Factory
-from m3u8_downloader import M3U8Downloader
+from decryption import Decrypter, StreamDecryptor, get_segment_iv
+from keys import KeyCache
+from m3u8_downloader import M3U8Downloader, main as download_page
 from main import Downloader
-from utils import read_file
+from merge import ReorderBuffer, append_file, get_backends
+from metrics import Exporter, Metrics
+from mirrors import MirrorProber
+from mpegts import probe
+from profiler import Profiler, Tracer
+from progress import ProgressBoard
+from scheduler import Hedger, Scheduler
+from state import StateStore
+from synthetic import h264_sps, hevc_sps, make_ts
+from variants import VariantSelector
+from workers import QueueWorker
+from utils import Logger, read_file
+from validator import Validator, validate
+
+
+class MockStream:
+    def __init__(self, content: bytes):
+        self._content = io.BytesIO(content)
+
+    async def readexactly(self, n: int):
+        return self._content.read(n)
+
+    async def iter_chunked(self, n: int):
+        for chunk in iter(lambda: self._content.read(n), b''):
+            yield chunk
+
+
+class StallingStream(MockStream):
+    def __init__(self, content: bytes, delay: float):
+        super().__init__(content)
+        self.delay = delay
+
+    async def iter_chunked(self, n: int):
+        await asyncio.sleep(self.delay)
+        async for chunk in super().iter_chunked(n):
+            yield chunk
 
 
 class MockResponse:
-    def __init__(self, content: bytes, headers: dict):
+    def __init__(self, content: bytes, headers: dict, status: int = 200):
         self._content = content
         self.headers = headers
+        self.status = status
+        self.content = MockStream(content)
 
     async def read(self):
         return self._content
@@ -54,10 +111,41 @@ def get_fixture(url: str):
     if 'szjal' in url:
         directory = 'szjal'
 
+    if 'rotate' in url:
+        directory = 'rotate'
+
+    if 'ads.example' in url:
+        directory = 'ads'
+
+    if 'variants.example' in url:
+        directory = 'variants'
+
+    if 'hedge.example' in url:
+        directory = 'hedge'
+
+    if 'fmp4.example' in url:
+        directory = 'fmp4'
+
+    if directory == 'fmp4' and file.endswith('.m4s'):
+        return (url + '\n').encode('utf-8')
+
+    if directory == 'ads' and file.endswith('.ts'):
+        width, height = (1280, 720) if file.startswith('ad') else (1920, 1080)
+        return make_ts(0x1b, h264_sps(width, height))
+
+    if directory == 'rotate' and file.endswith('.key'):
+        return file[0:4].encode('utf-8') * 4
+
     if re.search(r'\.ts$', url) is not None:
         content = (url + "\n").encode('utf-8')
+        if directory == 'rotate':
+            sequence = int(file[0:file.find('.')])
+            key = ('key1' if sequence < 2 else 'key2').encode('utf-8') * 4
+            content = AES.new(key, AES.MODE_CBC, get_segment_iv(None, sequence)).encrypt(pad(content, AES.block_size))
         if directory in ['yle888']:
-            cipher = AES.new(read_file(os.path.join('fixtures', directory, 'key.key')), AES.MODE_CBC)
+            sequence = ['1N6S6O1u.ts', 'Q0HXvpgA.ts'].index(file)
+            cipher = AES.new(read_file(os.path.join('fixtures', directory, 'key.key')), AES.MODE_CBC,
+                             get_segment_iv(None, sequence))
             content = cipher.encrypt(pad(content, AES.block_size))
 
         return content
@@ -95,6 +183,59 @@ def get_fixture(url: str):
             /20221207/Gqk5BD7f/1500kb/hls/Q0HXvpgA.ts 
             """.encode('utf-8')
 
+    if directory == 'rotate' and 'index.m3u8' in url:
+        return """#EXTM3U
+            #EXT-X-TARGETDURATION:4
+            #EXT-X-MEDIA-SEQUENCE:0
+            #EXT-X-KEY:METHOD=AES-128,URI="key1.key"
+            #EXTINF:4.0,
+            0.ts
+            #EXTINF:4.0,
+            1.ts
+            #EXT-X-KEY:METHOD=AES-128,URI="key2.key"
+            #EXTINF:4.0,
+            2.ts
+            #EXTINF:4.0,
+            3.ts
+            """.encode('utf-8')
+
+    if directory == 'ads' and 'discontinuity.m3u8' in url:
+        segments = ['#EXTINF:30.0,\nmain%d.ts' % index for index in range(6)]
+        segments.insert(3, '#EXT-X-DISCONTINUITY\n#EXTINF:5.0,\nad0.ts\n#EXTINF:5.0,\nad1.ts\n#EXT-X-DISCONTINUITY')
+        return ('#EXTM3U\n#EXT-X-TARGETDURATION:30\n' + '\n'.join(segments)).encode('utf-8')
+
+    if directory == 'ads' and 'index.m3u8' in url:
+        return """#EXTM3U
+            #EXT-X-TARGETDURATION:4
+            #EXTINF:4.0,
+            main0.ts
+            #EXTINF:4.0,
+            ad0.ts
+            #EXTINF:4.0,
+            main1.ts
+            """.encode('utf-8')
+
+    if directory == 'fmp4' and file == 'index.m3u8':
+        segments = ['#EXTINF:4.0,\n%d.m4s' % index for index in range(2)]
+        return ('#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXT-X-MAP:URI="init.mp4"\n' + '\n'.join(segments)).encode('utf-8')
+
+    if directory == 'hedge' and file == 'index.m3u8':
+        segments = ['#EXTINF:4.0,\n%d.ts' % index for index in range(12)]
+        return ('#EXTM3U\n#EXT-X-TARGETDURATION:4\n' + '\n'.join(segments)).encode('utf-8')
+
+    if directory == 'variants' and file == 'master.m3u8':
+        return """#EXTM3U
+            #EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360
+            360p/index.m3u8
+            #EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080
+            1080p/index.m3u8
+            #EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720
+            720p/index.m3u8
+            """.encode('utf-8')
+
+    if directory == 'variants' and file == 'index.m3u8':
+        return '#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXTINF:4.0,\n0.ts\n'.encode('utf-8')
+
     if directory == 'szjal' and 'index.m3u8' in url:
         return """#EXTM3U
             #EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=1000000,RESOLUTION=1080x606
@@ -123,6 +264,13 @@ def mock_response(*args, **kwargs):
     content = get_fixture(args[0])
     headers = {'Accept-Ranges': 'bytes', 'Content-Length': len(content)}
 
+    matched = re.match(r'bytes=(\d+)-', (kwargs.get('headers') or {}).get('Range', ''))
+    if matched is not None:
+        content = content[int(matched.group(1)):]
+        headers['Content-Length'] = len(content)
+
+        return MockResponse(content=content, headers=headers, status=206)
+
     return MockResponse(content=content, headers=headers)
 
 
@@ -175,6 +323,23 @@ async def test_bowang_crawler(mock_http: Http):
     assert 'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8' == page.m3u8
 
 
+@pytest.mark.asyncio
+async def test_bowang_crawler_fetches_only_allowed_episodes_in_order(mock_http: Http):
+    url = 'https://bowang.su/play/126771-4-1.html'
+    delays = iter([0.03, 0.02, 0.01, 0])
+
+    async def get(page_url: str):
+        await asyncio.sleep(next(delays))
+        return get_fixture(page_url)
+
+    crawler = Factory(mock_http).create(url)
+    with patch.object(Http, 'get', side_effect=get) as mock:
+        pages = [page async for page in (crawler.pages('DB', url, 3, 5))]
+
+    assert ['003', '004', '005'] == [page.episode for page in pages]
+    assert 4 == mock.call_count
+
+
 @pytest.mark.asyncio
 async def test_bowang_crawler_episode_hd(mock_http: Http):
     name = "銀魂劇場版：新譯紅櫻篇HD"
@@ -252,6 +417,170 @@ async def test_m3u8_downloader_and_decrypt_content(mocker: MockFixture, mock_htt
     downloader = M3U8Downloader(root, mock_http)
     await downloader.download(page)
 
+    content = read_file('%s/%s/%s.mp4' % (root, page.name, page.episode))
+    assert b'https://new.yle888.vip/20221207/Gqk5BD7f/1500kb/hls/1N6S6O1u.ts\n' in content
+    assert b'https://new.yle888.vip/20221207/Gqk5BD7f/1500kb/hls/Q0HXvpgA.ts\n' in content
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_decrypts_rotating_keys_with_one_fetch_per_key(mocker: MockFixture, mock_http: Http,
+                                                                              my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    base = 'https://cdn.rotate.example/hls'
+    downloader = M3U8Downloader(root, mock_http)
+    await downloader.download(Page('Rotate', 1, 'https://bowang.su/play/126771-4-1.html', f'{base}/index.m3u8'))
+    await downloader.download(Page('Rotate', 2, 'https://bowang.su/play/126771-4-2.html', f'{base}/index.m3u8'))
+
+    for episode in ['001', '002']:
+        content = read_file(os.path.join(root, 'Rotate', f'{episode}.mp4'))
+        assert b''.join((f'{base}/{index}.ts\n').encode('utf-8') for index in range(4)) == content
+
+    urls = [call.args[0] for call in aiohttp.ClientSession.get.call_args_list]
+    assert 1 == urls.count(f'{base}/key1.key')
+    assert 1 == urls.count(f'{base}/key2.key')
+
+
+@pytest.mark.asyncio
+async def test_key_cache_collapses_concurrent_fetches_and_persists_to_disk(mock_http: Http, my_fs):
+    uri = 'https://cdn.rotate.example/hls/key1.key'
+
+    with patch.object(Http, 'get', wraps=mock_http.get) as mock:
+        keys = KeyCache(mock_http, 'video-test/.keys')
+        assert [b'key1' * 4] * 3 == await asyncio.gather(*[keys.get(uri) for _ in range(3)])
+        assert 1 == mock.call_count
+
+        assert b'key1' * 4 == await KeyCache(mock_http, 'video-test/.keys').get(uri)
+        assert 1 == mock.call_count
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_drops_ads_by_transport_stream_resolution(mocker: MockFixture, mock_http: Http, my_fs):
+    ffprobe = mocker.patch('videoprops.get_video_properties')
+
+    root = 'video-test'
+    downloader = M3U8Downloader(root, mock_http, keep_segments=False)
+    await downloader.download(Page('Ads', 1, 'https://bowang.su/play/126771-4-1.html', 'https://ads.example/index.m3u8'))
+
+    main = make_ts(0x1b, h264_sps(1920, 1080))
+    assert main * 2 == read_file(os.path.join(root, 'Ads', '001.mp4'))
+    assert not ffprobe.called
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_refetches_only_invalid_segments(mocker: MockFixture, mock_http: Http, my_fs):
+    broken = []
+
+    def corrupted_response(*args, **kwargs):
+        response = mock_response(*args, **kwargs)
+        if args[0].endswith('/main1.ts') and not broken:
+            broken.append(args[0])
+            response.content = MockStream(get_fixture(args[0])[:-100])
+        return response
+
+    mocker.patch('aiohttp.ClientSession.get', side_effect=corrupted_response)
+    root = 'video-test'
+    downloader = M3U8Downloader(root, mock_http, skip_ads=False, validator=Validator(), backoff=Backoff(0, 0))
+    await downloader.download(
+        Page('Ads', 1, 'https://bowang.su/play/126771-4-1.html', 'https://ads.example/index.m3u8')
+    )
+
+    fetched = [call.args[0].rsplit('/', 1)[1] for call in aiohttp.ClientSession.get.call_args_list]
+    assert {'main0.ts': 1, 'ad0.ts': 1, 'main1.ts': 2} == Counter(fetched[1:])
+    assert make_ts(0x1b, h264_sps(1920, 1080)) * 2 == read_file(os.path.join(root, 'Ads', '001.mp4'))
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_fetches_invalid_segment_once_more_and_skips_fmp4(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    def corrupted_response(*args, **kwargs):
+        response = mock_response(*args, **kwargs)
+        if args[0].endswith('/main1.ts'):
+            response.content = MockStream(get_fixture(args[0])[:-100])
+        return response
+
+    mocker.patch('aiohttp.ClientSession.get', side_effect=corrupted_response)
+    root = 'video-test'
+    downloader = M3U8Downloader(root, mock_http, skip_ads=False, validator=Validator(), backoff=Backoff(0, 0))
+
+    assert not await downloader.download(
+        Page('Ads', 1, 'https://bowang.su/play/126771-4-1.html', 'https://ads.example/index.m3u8')
+    )
+    fetched = [call.args[0].rsplit('/', 1)[1] for call in aiohttp.ClientSession.get.call_args_list]
+    assert 2 == fetched.count('main1.ts')
+
+    assert await downloader.download(
+        Page('CMAF', 1, 'https://bowang.su/play/126771-4-1.html', 'https://fmp4.example/index.m3u8')
+    )
+    expected = b''.join(get_fixture('https://fmp4.example/%d.m4s' % index) for index in range(2))
+    assert expected == read_file(os.path.join(root, 'CMAF', '001.mp4'))
+
+
+def test_ad_detector_marks_foreign_discontinuity_runs():
+    url = 'https://vip.ffzy-online2.com/20221231/3982_a82a6172/2000k/hls/mixed.m3u8'
+    playlist = m3u8.loads(read_file('fixtures/ffzy-online2/mixed.m3u8').decode('utf-8'), url)
+
+    runs = AdDetector().analyze(playlist)
+
+    assert 39 == len(runs)
+    assert [151, 152, 153, 154] == AdDetector.skipped(runs)
+    assert [] == AdDetector.skipped(AdDetector().analyze(m3u8.load('fixtures/gimy/index.m3u8')))
+
+
+def test_ad_detector_ignores_names_when_segments_are_hashed():
+    def segment(index: int, duration: float) -> str:
+        return '#EXTINF:%.1f,\n/hls/%s.ts' % (duration, hashlib.md5(str(index).encode()).hexdigest()[:8])
+
+    opening = [segment(index, 6.0) for index in range(15)]
+    content = [segment(index, 6.5) for index in range(15, 200)]
+    text = '#EXTM3U\n#EXT-X-TARGETDURATION:7\n' + '\n'.join(opening + ['#EXT-X-DISCONTINUITY'] + content)
+    runs = AdDetector().analyze(m3u8.loads(text, 'https://cdn.example/hls/index.m3u8'))
+
+    assert [(0, 15, 1, False), (15, 200, 0, False)] == [
+        (run.start, run.start + len(run.segments), run.score, run.skipped) for run in runs
+    ]
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_never_fetches_playlist_ads(mocker: MockFixture, mock_http: Http, my_fs):
+    root = 'video-test'
+    downloader = M3U8Downloader(root, mock_http)
+    await downloader.download(
+        Page('Ads', 1, 'https://bowang.su/play/126771-4-1.html', 'https://ads.example/discontinuity.m3u8')
+    )
+
+    assert make_ts(0x1b, h264_sps(1920, 1080)) * 6 == read_file(os.path.join(root, 'Ads', '001.mp4'))
+    assert not any(call.args[0].endswith(('/ad0.ts', '/ad1.ts')) for call in aiohttp.ClientSession.get.call_args_list)
+
+
+def test_variant_selector_ranks_by_policy():
+    url = 'https://variants.example/master.m3u8'
+    playlists = m3u8.loads(get_fixture(url).decode('utf-8'), url).playlists
+
+    def heights(selector: VariantSelector, throughput: float = None):
+        return [playlist.stream_info.resolution[1] for playlist in selector.rank(playlists, throughput)]
+
+    assert [1080, 720, 360] == heights(VariantSelector('highest'))
+    assert [360, 720, 1080] == heights(VariantSelector('lowest'))
+    assert [720, 360, 1080] == heights(VariantSelector('resolution', 900))
+    assert [720, 360, 1080] == heights(VariantSelector('throughput'), 500 * 1024)
+    assert [1080, 720, 360] == heights(VariantSelector('throughput'))
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_follows_selected_variant(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    downloader = M3U8Downloader(root, mock_http, variants=VariantSelector('resolution', 720))
+    await downloader.download(
+        Page('Variants', 1, 'https://bowang.su/play/126771-4-1.html', 'https://variants.example/master.m3u8')
+    )
+
+    assert b'https://variants.example/720p/0.ts\n' == read_file(os.path.join(root, 'Variants', '001.mp4'))
+
 
 @pytest.mark.asyncio
 async def test_m3u8_downloader_relative_path(mocker: MockFixture, mock_http: Http, my_fs):
@@ -271,6 +600,227 @@ async def test_m3u8_downloader_relative_path(mocker: MockFixture, mock_http: Htt
         assert mock.call_args_list[1].args[0] == 'https://n1.szjal.cn/ppvod/B2730CCCD100BD33DB10092BFB3C683C.m3u8'
 
 
+@pytest.mark.asyncio
+async def test_m3u8_downloader_resumes_from_state_store_without_requests(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    page = Page('DB', 1, 'https://bowang.su/play/126771-4-1.html',
+                'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8')
+    downloader = M3U8Downloader(root, mock_http)
+    await downloader.download(page)
+    os.unlink(os.path.join(root, 'DB', '001.mp4'))
+
+    aiohttp.ClientSession.get.reset_mock()
+    await downloader.download(page)
+
+    assert all(call.args[0].endswith('.m3u8') for call in aiohttp.ClientSession.get.call_args_list)
+    assert not aiohttp.ClientSession.head.called
+    assert os.path.exists(os.path.join(root, 'DB', '001.mp4'))
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_records_metrics_per_stage(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    page = Page('DB', 1, 'https://bowang.su/play/126771-4-1.html',
+                'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8')
+    metrics = Metrics()
+    downloader = M3U8Downloader(root, mock_http, metrics=metrics)
+    await downloader.download(page)
+    os.unlink(os.path.join(root, 'DB', '001.mp4'))
+    await downloader.download(page)
+
+    snapshot = metrics.snapshot()
+    statuses = Counter()
+    for counter in snapshot['counters']:
+        if counter['name'] == 'segments_total':
+            statuses[counter['labels']['status']] += counter['value']
+    assert statuses['downloaded'] == statuses['cached'] > 0
+    assert 2 * os.path.getsize(os.path.join(root, 'DB', '001.mp4')) == metrics.total('merge_bytes_total')
+    assert metrics.total('segment_bytes_total') > 0
+    assert [2] == [histogram['count'] for histogram in snapshot['histograms'] if histogram['name'] == 'playlist_seconds']
+
+    async with Exporter(metrics, jsonl=os.path.join(root, 'metrics.jsonl'), prometheus=os.path.join(root, 'metrics.prom')):
+        pass
+    assert json.loads(read_file(os.path.join(root, 'metrics.jsonl')))['summary']['segments_per_second'] > 0
+
+    text = read_file(os.path.join(root, 'metrics.prom')).decode()
+    assert '# TYPE segments_total counter' in text
+    assert 'segments_total{host="vip.ffzy-online2.com",status="cached"}' in text
+    assert '# TYPE segment_seconds histogram' in text
+    assert 'segment_seconds_bucket{host="vip.ffzy-online2.com",le="+Inf"}' in text
+
+
+@pytest.mark.asyncio
+async def test_progress_board_redraws_episodes_in_place_and_keeps_log_lines_above(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    stream = io.StringIO()
+    board = ProgressBoard(stream, interval=60, tty=True)
+    async with board:
+        board.start(1, 'DB/001.mp4', 100)
+        board.start(2, 'DB/002.mp4', 50)
+        board.advance(1, done=25, size=1024)
+        board.update(1, merged=20)
+        board.render()
+        assert ['DB/001.mp4', 'DB/002.mp4'] == [re.match(r'\[(.+?)]', line).group(1) for line in board.lines()]
+        assert '00025/00100' in board.lines()[0] and 'ETA' in board.lines()[0]
+
+        Logger().warning('retry')
+        board.finish(2)
+        board.render()
+    output = stream.getvalue()
+    # each redraw moves back over the two lines drawn before it
+    assert output.count('\033[2F\033[J') == 2
+    assert output.rindex('retry') < output.rindex('DB/001.mp4')
+
+    stream = io.StringIO()
+    board = ProgressBoard(stream, tty=False)
+    spy = mocker.spy(board, 'update')
+    page = Page('DB', 1, 'https://bowang.su/play/126771-4-1.html',
+                'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8')
+    async with board:
+        await M3U8Downloader('video-test', mock_http, board=board).download(page)
+        board.start(3, 'DB/003.mp4', 10)
+    total = spy.call_args_list[0].kwargs['total']
+    assert {'merged': total} == spy.call_args_list[-1].kwargs
+    assert 'progress: 1 active' in stream.getvalue() and '\033' not in stream.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_progress_board_serializes_log_lines_from_threads():
+    class SlowStream(io.StringIO):
+        writing = 0
+        overlapped = False
+
+        def write(self, text):
+            self.writing += 1
+            self.overlapped = self.overlapped or self.writing > 1
+            time.sleep(0.001)
+            self.writing -= 1
+            return super().write(text)
+
+    stream = SlowStream()
+    board = ProgressBoard(stream, interval=0.001, tty=True)
+    async with board:
+        board.start(1, 'DB/001.mp4', 100)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(None, Logger().debug, 'accept %d' % index) for index in range(20)
+        ])
+
+    assert not stream.overlapped
+    assert all('accept %d' % index in stream.getvalue() for index in range(20))
+
+
+@pytest.mark.asyncio
+async def test_profiler_traces_episodes_segments_tasks_and_slow_callbacks(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    page = Page('DB', 1, 'https://bowang.su/play/126771-4-1.html',
+                'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8')
+    tracer = Tracer()
+    mocker.patch('m3u8_downloader.TRACER', tracer)
+
+    async def block():
+        time.sleep(0.03)
+
+    async with Profiler('profile', slow_callback=0.02, tracer=tracer):
+        await M3U8Downloader('video-test', mock_http).download(page)
+        await asyncio.ensure_future(block())
+    assert not asyncio.get_running_loop().get_debug()
+
+    events = json.loads(read_file(os.path.join('profile', 'trace.json')))['traceEvents']
+    phases = Counter((event.get('cat'), event['name'], event['ph']) for event in events)
+    assert 1 == phases['download', 'episode', 'b'] == phases['download', 'episode', 'e']
+    assert phases['download', 'segment', 'b'] == phases['download', 'segment', 'e'] > 0
+    assert phases['executor', 'ReorderBuffer.__append', 'X'] > 0
+    assert any(event.get('cat') == 'asyncio' and 'block' in event['args']['callback'] for event in events)
+    assert phases['task', 'test_profiler_traces_episodes_segments_tasks_and_slow_callbacks.<locals>.block', 'e'] == 1
+
+    report = read_file(os.path.join('profile', 'profile.txt')).decode()
+    assert re.search(r'^download\s+segment\s+\d+', report, re.M)
+    assert 'slowest callbacks' in report and 'cumulative' in report
+    assert os.path.exists(os.path.join('profile', 'profile.pstats'))
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_entry_point_keeps_segment_state_on_disk(mocker: MockFixture, mock_http: Http, tmp_path):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+    board = mocker.spy(ProgressBoard, '__aenter__')
+
+    root = str(tmp_path / 'video')
+    page = Page('DB', 1, 'https://bowang.su/play/126771-4-1.html',
+                'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8')
+    await download_page(page, root=root)
+    assert board.called
+    os.unlink(os.path.join(root, 'DB', '001.mp4'))
+
+    aiohttp.ClientSession.get.reset_mock()
+    await download_page(page, root=root)
+
+    assert os.path.exists(os.path.join(root, 'state.db'))
+    assert all(call.args[0].endswith('.m3u8') for call in aiohttp.ClientSession.get.call_args_list)
+    assert not aiohttp.ClientSession.head.called
+
+
+def test_state_store_shares_segment_claims_between_processes(tmp_path):
+    first = StateStore(str(tmp_path / 'state.db'), owner='first', lease=60)
+    second = StateStore(str(tmp_path / 'state.db'), owner='second', lease=-1)
+    episode = first.episode('DB', '001')
+    assert episode == second.episode('DB', '001')
+
+    assert first.claim(episode, 0)
+    assert not second.claim(episode, 0)
+    assert second.claim(episode, 1)
+    # an expired lease is taken over
+    assert first.claim(episode, 1)
+
+    filename = tmp_path / '00000.ts'
+    filename.write_bytes(b'segment')
+    first.complete(episode, 0, str(filename), 'https://example.com/0.ts', 'https://example.com/key.key')
+    assert second.is_complete(episode, 0, str(filename), 'https://example.com/0.ts')
+    assert not second.claim(episode, 0)
+    assert 'https://example.com/key.key' == second.segment(episode, 0)['key_uri']
+
+    assert [str(filename)] == second.start(episode, 0)
+    assert 0 == first.count(episode)
+
+
+def test_state_store_uses_rollback_journal_when_shared_between_hosts(tmp_path):
+    import sqlite3
+
+    StateStore(str(tmp_path / 'local.db')).close()
+    StateStore(str(tmp_path / 'shared.db'), journal='DELETE').close()
+
+    def journal_mode(name: str) -> str:
+        return sqlite3.connect(str(tmp_path / name)).execute('PRAGMA journal_mode').fetchone()[0]
+
+    assert 'wal' == journal_mode('local.db')
+    assert 'delete' == journal_mode('shared.db')
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_resumes_partial_segment_with_range(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    ts = 'https://vip.ffzy-online2.com/20221231/3982_a82a6172/2000k/hls/d5f7e4b581e000000.ts'
+    page = Page('DB', 1, 'https://bowang.su/play/126771-4-1.html',
+                'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8')
+    my_fs.create_file(os.path.join(root, 'DB', '001', '00000.ts.part'), contents=get_fixture(ts)[:10])
+
+    downloader = M3U8Downloader(root, mock_http)
+    await downloader.download(page)
+
+    call = aiohttp.ClientSession.get.call_args_list[-1]
+    assert ts == call.args[0]
+    assert 'bytes=10-' == call.kwargs['headers']['Range']
+    assert get_fixture(ts) == read_file(os.path.join(root, 'DB', '001.mp4'))
+
+
 @pytest.mark.asyncio
 async def test_downloader(mocker: MockFixture, mock_http: Http, my_fs):
     mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
@@ -285,6 +835,649 @@ async def test_downloader(mocker: MockFixture, mock_http: Http, my_fs):
     assert 153 == len(glob.glob(os.path.join(root, name, '*.mp4')))
 
 
+@pytest.mark.asyncio
+async def test_crawlers_enumerate_play_sources_fastest_first(mock_http: Http):
+    url = 'https://bowang.su/play/126771-4-1.html'
+    prober = MagicMock()
+    prober.rank = AsyncMock(side_effect=lambda urls: list(reversed(range(len(urls)))))
+
+    pages = [page async for page in Factory(mock_http, prober).create(url).pages('DB', url, 1, 1)]
+
+    assert 'https://bowang.su/play/126771-3-1.html' == pages[0].url
+    assert [
+               'https://bowang.su/play/126771-1-1.html',
+               'https://bowang.su/play/126771-2-1.html',
+               'https://bowang.su/play/126771-4-1.html',
+           ] == pages[0].mirrors
+
+    url = 'https://gimy.im/play/16447-8-1.html'
+    pages = [page async for page in Factory(mock_http).create(url).pages('魔神英雄傳', url, 1, 1)]
+
+    assert 'https://gimy.im/play/16447-8-1.html' == pages[0].url
+    assert 8 == len(pages[0].mirrors)
+
+
+@pytest.mark.asyncio
+async def test_mirror_prober_ranks_dead_mirrors_last(mock_http: Http):
+    prober = MirrorProber(mock_http)
+
+    probe = await prober.probe('https://variants.example/master.m3u8')
+    assert probe.ok
+
+    assert [1, 0] == await prober.rank(['https://ads.example/missing.m3u8', 'https://variants.example/master.m3u8'])
+
+
+@pytest.mark.asyncio
+async def test_downloader_fails_over_to_next_source(mocker: MockFixture, mock_http: Http, my_fs):
+    url = 'https://bowang.su/play/126771-4-1.html'
+    m3u8_downloader = M3U8Downloader('video-test', mock_http)
+    mocker.patch.object(m3u8_downloader, 'download', side_effect=[False, True])
+
+    await Downloader(Factory(mock_http), m3u8_downloader).download('DB', url, 1, 1)
+
+    assert [
+               'https://bowang.su/play/126771-4-1.html',
+               'https://bowang.su/play/126771-2-1.html',
+           ] == [call.args[0].url for call in m3u8_downloader.download.call_args_list]
+
+
+@pytest.mark.asyncio
+async def test_downloader_fails_over_when_playlist_is_dead(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    def dead_response(*args, **kwargs):
+        if 'dead.example' in args[0]:
+            raise aiohttp.ClientConnectionError('connection refused')
+        return mock_response(*args, **kwargs)
+
+    mocker.patch('aiohttp.ClientSession.get', side_effect=dead_response)
+    url = 'https://bowang.su/play/126771-4-1.html'
+    mirror = 'https://bowang.su/play/126771-2-1.html'
+    page = Page('DB', 1, url, 'https://dead.example/index.m3u8', [mirror])
+    crawler = Factory(mock_http).create(url)
+    mocker.patch.object(crawler, 'mirror', AsyncMock(return_value=Page(
+        'DB', 1, mirror, 'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8'
+    )))
+    m3u8_downloader = M3U8Downloader('video-test', mock_http, backoff=Backoff(0, 0), playlist_tries=2)
+
+    assert await asyncio.wait_for(Downloader(Factory(mock_http), m3u8_downloader).fetch(page, crawler), 5)
+    assert os.path.exists(os.path.join('video-test', 'DB', '001.mp4'))
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_gives_up_on_stalled_source(mocker: MockFixture, mock_http: Http, my_fs):
+    class StalledStream(MockStream):
+        async def iter_chunked(self, n: int):
+            await asyncio.sleep(3600)
+            yield b''
+
+    def stalled_response(*args, **kwargs):
+        response = mock_response(*args, **kwargs)
+        if args[0].endswith('.ts'):
+            response.content = StalledStream(b'')
+        return response
+
+    mocker.patch('aiohttp.ClientSession.get', side_effect=stalled_response)
+    page = Page('DB', 1, 'https://bowang.su/play/126771-4-1.html',
+                'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8')
+
+    downloader = M3U8Downloader('video-test', mock_http, stall_timeout=0.1)
+
+    assert not await asyncio.wait_for(downloader.download(page), 5)
+    assert not os.path.exists(os.path.join('video-test', 'DB', '001.mp4'))
+
+
+@pytest.mark.asyncio
+async def test_response_cache_revalidates_stale_entries_and_evicts_least_recently_used(mocker: MockFixture, my_fs):
+    http = Http()
+    request = mocker.patch.object(http, 'request', side_effect=[
+        (200, {'ETag': '"v1"'}, b'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1\nlow.m3u8\n'),
+        (304, {}, None),
+        (200, {}, b'x' * 60),
+    ])
+    cache = ResponseCache(http, '.cache', ttls={'master': 0}, max_size=100)
+    url = 'https://variants.example/master.m3u8'
+
+    content = await cache.get(url, 'playlist')
+
+    assert content == await cache.get(url, 'playlist')
+    assert {'If-None-Match': '"v1"'} == request.call_args_list[1].args[1]
+
+    await cache.get('https://bowang.su/play/126771-4-1.html')
+    assert ['.cache/' + hashlib.sha1(b'https://bowang.su/play/126771-4-1.html').hexdigest()] == [
+        filename for filename in glob.glob('.cache/*') if not filename.endswith('.json')
+    ]
+
+    cache.ttls['html'] = 60
+    assert b'x' * 60 == await cache.get('https://bowang.su/play/126771-4-1.html')
+    assert 3 == request.call_count
+
+
+@pytest.mark.asyncio
+async def test_batch_runner_records_job_status_and_skips_finished_jobs(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    my_fs.create_file('jobs.jsonl', contents='\n'.join([
+        json.dumps({'name': 'DB', 'url': 'https://bowang.su/play/126771-4-1.html', 'start': 1, 'end': 2}),
+        'not json',
+        json.dumps({'id': 'rotate', 'name': 'Rotate', 'm3u8': 'https://rotate.example/index.m3u8'}),
+    ]))
+    state = StateStore()
+    m3u8_downloader = M3U8Downloader(root, mock_http, state=state)
+    runner = BatchRunner(Downloader(Factory(mock_http), m3u8_downloader), state, jobs=2)
+
+    jobs = list(read_jobs('jobs.jsonl'))
+    await runner.run(jobs)
+
+    assert ['done', 'done'] == [state.job(job.id)['status'] for job in jobs]
+    assert 2 == len(glob.glob(os.path.join(root, 'DB', '*.mp4')))
+    assert os.path.exists(os.path.join(root, 'Rotate', '001.mp4'))
+
+    download = mocker.spy(m3u8_downloader, 'download')
+    await runner.run(read_jobs('jobs.jsonl'))
+    assert not download.called
+
+
+@pytest.mark.asyncio
+async def test_batch_runner_fails_series_job_when_an_episode_fails(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    my_fs.create_file('jobs.jsonl', contents=json.dumps(
+        {'name': 'DB', 'url': 'https://bowang.su/play/126771-4-1.html', 'start': 1, 'end': 3}
+    ))
+    state = StateStore()
+    m3u8_downloader = M3U8Downloader('video-test', mock_http, state=state)
+    download = m3u8_downloader.download
+
+    async def fail_second(page: Page) -> bool:
+        return page.episode != '002' and await download(page)
+
+    mocker.patch.object(m3u8_downloader, 'download', side_effect=fail_second)
+    downloader = Downloader(Factory(mock_http), m3u8_downloader)
+    runner = BatchRunner(downloader, state)
+
+    job = next(read_jobs('jobs.jsonl'))
+    await runner.run([job])
+
+    assert 'failed' == state.job(job.id)['status']
+    assert {'001': True, '002': False, '003': True} == await downloader.download('DB', job.spec['url'], 1, 3)
+
+
+@pytest.mark.asyncio
+async def test_batch_runner_renews_job_lease_while_running(mocker: MockFixture, tmp_path):
+    state = StateStore(str(tmp_path / 'state.db'), owner='first:1', lease=0.3)
+    other = StateStore(str(tmp_path / 'state.db'), owner='second:1')
+    job = Job({'name': 'DB', 'm3u8': 'https://example.com/index.m3u8'})
+    claimed = []
+
+    async def download(page: Page):
+        await asyncio.sleep(0.6)
+        claimed.append(other.claim_job(job.id, json.dumps(job.spec)))
+        return True
+
+    m3u8_downloader = MagicMock()
+    m3u8_downloader.download = download
+    await BatchRunner(Downloader(MagicMock(), m3u8_downloader), state).run([job])
+
+    assert [False] == claimed
+    assert 'done' == state.job(job.id)['status']
+
+
+def test_state_store_reclaims_jobs_of_killed_processes_on_this_host(tmp_path):
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    killed = StateStore(str(tmp_path / 'state.db'), owner='%s:%d' % (socket.gethostname(), process.pid))
+    remote = StateStore(str(tmp_path / 'state.db'), owner='elsewhere:%d' % process.pid)
+    rerun = StateStore(str(tmp_path / 'state.db'))
+
+    assert killed.claim_job('dead', '{}')
+    assert remote.claim_job('remote', '{}')
+
+    assert rerun.claim_job('dead', '{}')
+    assert not rerun.claim_job('remote', '{}')
+
+
+@pytest.mark.asyncio
+async def test_worker_claims_and_completes_segments_off_the_event_loop(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+    threads = []
+
+    def record(method):
+        def call(self, *args):
+            threads.append((method.__name__, threading.get_ident()))
+            return method(self, *args)
+        return call
+
+    for name in ('claim', 'complete'):
+        mocker.patch.object(StateStore, name, record(getattr(StateStore, name)))
+
+    downloader = M3U8Downloader('video-test', mock_http, skip_ads=False)
+    assert await downloader.download(
+        Page('Ads', 1, 'https://bowang.su/play/126771-4-1.html', 'https://ads.example/index.m3u8')
+    )
+
+    assert 6 == len(threads)
+    assert threading.get_ident() not in [thread for _, thread in threads]
+
+
+def test_state_store_queue_reassigns_episodes_of_dead_workers(tmp_path):
+    dead = StateStore(str(tmp_path / 'state.db'), owner='dead', lease=-1)
+    alive = StateStore(str(tmp_path / 'state.db'), owner='alive', lease=60)
+    assert dead.enqueue('DB', '001', 'https://bowang.su/play/126771-4-1.html', 'https://example.com/1.m3u8')
+    assert dead.enqueue('DB', '002', 'https://bowang.su/play/126771-4-2.html', 'https://example.com/2.m3u8')
+    assert not alive.enqueue('DB', '001', 'https://bowang.su/play/126771-4-1.html', 'https://example.com/1.m3u8')
+
+    assert '001' == dead.claim_episode()['episode']
+    assert '002' == alive.claim_episode()['episode']
+    # the dead worker's lease ran out, the episode goes to whoever asks next
+    entry = alive.claim_episode()
+    assert '001' == entry['episode']
+    assert 2 == entry['attempts']
+    assert alive.claim_episode() is None
+
+    assert not dead.finish_episode(entry['id'])
+    assert alive.finish_episode(entry['id'])
+    assert 1 == alive.remaining()
+
+
+@pytest.mark.asyncio
+async def test_queue_worker_downloads_queued_episodes(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    state = StateStore()
+    worker = QueueWorker(Downloader(Factory(mock_http), M3U8Downloader(root, mock_http, state=state)), state, 2)
+    job = Job({'name': 'DB', 'url': 'https://bowang.su/play/126771-4-1.html', 'start': 1, 'end': 3})
+
+    assert 3 == await worker.enqueue(job)
+    await asyncio.wait_for(worker.run(), 5)
+
+    assert 0 == state.remaining()
+    assert ['001', '002', '003'] == [entry['episode'] for entry in state.queued('done')]
+    assert 3 == len(glob.glob(os.path.join(root, 'DB', '*.mp4')))
+
+
+@pytest.mark.asyncio
+async def test_http_shares_one_pooled_session(mock_http: Http):
+    url = 'https://vip.ffzy-online2.com/20221231/3982_a82a6172/index.m3u8'
+
+    async with mock_http as http:
+        session = http.session()
+        await http.get(url)
+        await http.head(url)
+
+        assert session is http.session()
+        assert session.connector.limit == 100
+        assert session.connector.limit_per_host == 64
+        assert session.timeout.sock_connect == 5
+        assert session.timeout.sock_read == 10
+
+    assert session.closed
+
+
+@pytest.mark.asyncio
+async def test_scheduler_runs_earliest_segments_first_within_limit():
+    started = []
+    running = 0
+    peak = 0
+
+    async def job(index):
+        nonlocal running, peak
+        started.append(index)
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    scheduler = Scheduler(concurrency=3)
+    for index in reversed(range(10)):
+        scheduler.submit(index, partial(job, index))
+    await scheduler.join()
+
+    assert list(range(10)) == started
+    assert 3 == peak
+
+
+@pytest.mark.asyncio
+async def test_scheduler_cancels_remaining_segments_on_failure():
+    finished = []
+
+    async def job(index):
+        await asyncio.sleep(0.01)
+        if index == 1:
+            raise ValueError('segment %d failed' % index)
+        finished.append(index)
+
+    scheduler = Scheduler(concurrency=2)
+    for index in range(10):
+        scheduler.submit(index, partial(job, index))
+
+    with pytest.raises(ValueError):
+        await scheduler.join()
+
+    assert [0] == finished
+
+
+@pytest.mark.asyncio
+async def test_scheduler_hedges_straggler_and_cancels_the_slower_copy():
+    finished = []
+    cancelled = []
+
+    async def job(index, progress, hedged=False):
+        try:
+            progress.start()
+            await asyncio.sleep(10 if index == 11 and not hedged else 0.01)
+            progress.size += 1024
+            finished.append((index, hedged))
+        except asyncio.CancelledError:
+            cancelled.append((index, hedged))
+            raise
+
+    hedger = Hedger(budget=1, interval=0.01)
+    scheduler = Scheduler(concurrency=12, hedger=hedger)
+    for index in range(12):
+        scheduler.submit(index, partial(job, index), hedge=partial(job, index, hedged=True))
+    await asyncio.wait_for(scheduler.join(), 2)
+
+    assert (11, True) in finished
+    assert [(11, False)] == cancelled
+    assert 1 == hedger.hedged
+    assert 1 == hedger.won
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_merges_hedged_straggler_once(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+    straggler = 'https://hedge.example/0.ts'
+    requested = []
+
+    def respond(*args, **kwargs):
+        response = mock_response(*args, **kwargs)
+        requested.append(args[0])
+        if args[0] == straggler and requested.count(straggler) == 1:
+            # the first copy finishes while the hedged one is still merging what queued up behind it
+            response.content = StallingStream(get_fixture(straggler), 1)
+        return response
+
+    def slow_append(*args, **kwargs):
+        time.sleep(0.1)
+        return append_file(*args, **kwargs)
+
+    mocker.patch('aiohttp.ClientSession.get', side_effect=respond)
+    mocker.patch('merge.append_file', side_effect=slow_append)
+    add = mocker.spy(ReorderBuffer, 'add')
+
+    page = Page('hedge', 1, 'https://hedge.example/play.html', 'https://hedge.example/index.m3u8')
+    downloader = M3U8Downloader('video-test', mock_http, hedge_budget=0.1, stall_timeout=None)
+    assert await asyncio.wait_for(downloader.download(page), 5)
+
+    assert 2 == requested.count(straggler)
+    assert 12 == add.call_count
+    expected = b''.join(get_fixture('https://hedge.example/%d.ts' % index) for index in range(12))
+    assert expected == read_file(os.path.join('video-test', 'hedge', '001.mp4'))
+
+
+@pytest.mark.asyncio
+async def test_stream_decryptor_decrypts_chunks_and_resumes_from_previous_block():
+    key = get_random_bytes(16)
+    iv = get_random_bytes(16)
+    plain = get_random_bytes(1000)
+    encrypted = AES.new(key, AES.MODE_CBC, iv).encrypt(pad(plain, AES.block_size))
+
+    decryptor = StreamDecryptor(key, iv, batch_size=100)
+    chunks = [encrypted[i:i + 7] for i in range(0, len(encrypted), 7)]
+    assert plain == b''.join([await decryptor.update(chunk) for chunk in chunks]) + await decryptor.finalize()
+
+    chunk = AES.new(key, AES.MODE_CBC, iv).encrypt(plain * 64)
+    assert (plain * 64)[:-16] == await StreamDecryptor(key, iv).update(chunk)
+
+    offset = 512
+    decryptor = StreamDecryptor(key, encrypted[offset - 16:offset])
+    assert plain[offset:] == await decryptor.update(encrypted[offset:]) + await decryptor.finalize()
+
+
+@pytest.mark.asyncio
+async def test_decrypter_offloads_large_batches_to_process_pool():
+    key = get_random_bytes(16)
+    plain = get_random_bytes(64 * 1024)
+    encrypted = AES.new(key, AES.MODE_CBC, get_segment_iv(None, 7)).encrypt(plain)
+
+    decrypter = Decrypter(processes=1, threshold=1024)
+    try:
+        assert plain == await decrypter.decrypt(key, (7).to_bytes(16, 'big'), encrypted)
+        assert decrypter.executor() is decrypter.executor()
+    finally:
+        decrypter.close()
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_shuts_down_decrypter_pool(mocker: MockFixture, mock_http: Http, tmp_path):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+    shutdown = mocker.spy(ProcessPoolExecutor, 'shutdown')
+    decrypter = Decrypter(processes=1, threshold=0)
+
+    base = 'https://cdn.rotate.example/hls'
+    async with M3U8Downloader(str(tmp_path), mock_http, decrypter=decrypter) as downloader:
+        assert await downloader.download(Page('Rotate', 1, 'https://bowang.su/play/126771-4-1.html', f'{base}/index.m3u8'))
+        assert not shutdown.called
+
+    assert shutdown.called
+
+
+@pytest.mark.parametrize('backends', [[backend] for backend in get_backends()] + [[]])
+def test_append_file_copies_segments_in_order(tmp_path, backends):
+    files = []
+    for index in range(3):
+        file = tmp_path / ('%05d.ts' % index)
+        file.write_bytes(bytes([index]) * (100_000 + index))
+        files.append(str(file))
+
+    with open(tmp_path / 'out.mp4', 'wb', buffering=0) as fw:
+        fw.write(b'head')
+        sizes = [append_file(file, fw, backends, buffer_size=4096) for file in files]
+        fw.write(b'tail')
+
+    assert [100_000, 100_001, 100_002] == sizes
+    assert b'head' + b''.join(read_file(file) for file in files) + b'tail' == (tmp_path / 'out.mp4').read_bytes()
+
+
+def test_append_file_and_spool_finish_short_writes(tmp_path):
+    class ShortWriter(io.BytesIO):
+        def write(self, data):
+            return super().write(bytes(data[:1000]))
+
+    (tmp_path / '00000.ts').write_bytes(b'a' * 5000)
+    fw = ShortWriter()
+    append_file(str(tmp_path / '00000.ts'), fw)
+
+    spool = ReorderBuffer(fw, directory=str(tmp_path)).open(1)
+    spool.write(b'b' * 3000)
+    spool.append_to(fw)
+
+    assert b'a' * 5000 + b'b' * 3000 == fw.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_reorder_buffer_appends_in_order_and_spills_over_budget(tmp_path):
+    with open(tmp_path / 'out.mp4', 'wb', buffering=0) as fw:
+        buffer = ReorderBuffer(fw, directory=str(tmp_path), prefix='001', memory_budget=10)
+        spools = {}
+        for index in [2, 1, 3]:
+            spools[index] = buffer.open(index)
+            with spools[index] as spool:
+                spool.write(b'%d' % index * 6)
+
+        await buffer.add(2, spools[2])
+        await buffer.add(3, spools[3])
+        await buffer.add(1, spools[1])
+        assert 0 == buffer.next
+        assert [False, True, True] == [spools[index].spilled for index in [2, 1, 3]]
+
+        await buffer.skip(0)
+        assert 4 == buffer.next
+
+    assert b'111111222222333333' == (tmp_path / 'out.mp4').read_bytes()
+    assert [] == list(tmp_path.glob('.001.*.spool'))
+
+
+@pytest.mark.asyncio
+async def test_m3u8_downloader_without_segment_directory(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    base = 'https://cdn.rotate.example/hls'
+    downloader = M3U8Downloader(root, mock_http, keep_segments=False, memory_budget=100)
+    await downloader.download(Page('Rotate', 1, 'https://bowang.su/play/126771-4-1.html', f'{base}/index.m3u8'))
+
+    content = read_file(os.path.join(root, 'Rotate', '001.mp4'))
+    assert b''.join((f'{base}/{index}.ts\n').encode('utf-8') for index in range(4)) == content
+    assert ['001.mp4'] == os.listdir(os.path.join(root, 'Rotate'))
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_validator_reports_broken_transport_streams(mocker: MockFixture, tmp_path, vectorized):
+    if vectorized:
+        pytest.importorskip('numpy')
+    else:
+        mocker.patch('validator.numpy', None)
+    ts = make_ts(0x1b, h264_sps(1920, 1080))
+
+    def report(data: bytes):
+        (tmp_path / 'segment.ts').write_bytes(data)
+        return validate(str(tmp_path / 'segment.ts')).errors
+
+    def corrupt(offset: int, value: int):
+        return ts[:offset] + bytes([value]) + ts[offset + 1:]
+
+    assert [] == report(ts)
+    assert ['truncated: 100 trailing bytes'] == report(ts[:-88])
+    assert ['sync byte lost at packet 3'] == report(corrupt(188 * 3, 0))
+    assert ['continuity: 1 errors'] == report(corrupt(188 * 4 + 3, 0x10 | 5))
+    assert ['pes: 1 misaligned starts'] == report(corrupt(188 * 2 + 6, 0x02))
+    assert ['empty'] == report(b'')
+    assert ['no sync byte'] == report(b'https://example.com/0.ts\n')
+
+
+@pytest.mark.parametrize('vectorized', [True, False])
+def test_validator_skips_pes_alignment_for_section_streams(mocker: MockFixture, tmp_path, vectorized):
+    if vectorized:
+        pytest.importorskip('numpy')
+    else:
+        mocker.patch('validator.numpy', None)
+    ts = make_ts(0x86, h264_sps(1920, 1080))
+    (tmp_path / 'segment.ts').write_bytes(ts[:188 * 2 + 4] + b'\xfc\x30\x11' + ts[188 * 2 + 7:])
+
+    assert [] == validate(str(tmp_path / 'segment.ts')).errors
+
+
+@pytest.mark.asyncio
+async def test_validator_checks_small_segments_off_the_event_loop(mocker: MockFixture, tmp_path):
+    (tmp_path / 'segment.ts').write_bytes(make_ts(0x1b, h264_sps(1920, 1080)))
+    loop = asyncio.get_running_loop()
+    run_in_executor = mocker.spy(loop, 'run_in_executor')
+
+    report = await Validator().check(str(tmp_path / 'segment.ts'))
+
+    assert report.ok
+    run_in_executor.assert_called_once_with(None, validate, str(tmp_path / 'segment.ts'))
+
+
+def test_probe_reads_codec_and_size_from_transport_stream():
+    assert {'codec_name': 'h264', 'width': 1920, 'height': 1080} == probe(make_ts(0x1b, h264_sps(1920, 1080)))
+    assert {'codec_name': 'h264', 'width': 1280, 'height': 720} == probe(make_ts(0x1b, h264_sps(1280, 720)))
+    assert {'codec_name': 'hevc', 'width': 3840, 'height': 2160} == probe(make_ts(0x24, hevc_sps(3840, 2160)))
+    assert {} == probe(b'https://vip.ffzy-online2.com/2000k/hls/d5f7e4b581e000000.ts\n')
+    assert {} == probe(make_ts(0x1b, h264_sps(1920, 1080))[:400])
+
+
+@pytest.mark.asyncio
+async def test_downloader_pipelines_episodes(mocker: MockFixture, mock_http: Http, my_fs):
+    mocker.patch('videoprops.get_video_properties', return_value={'height': '960', 'width': '480'})
+
+    root = 'video-test'
+    name = "DB"
+    url = 'https://bowang.su/play/126771-4-1.html'
+
+    downloader = Downloader(Factory(mock_http), M3U8Downloader(root, mock_http, budget=4), episodes=4)
+    await downloader.download(name, url, 1, 20)
+
+    assert 20 == len(glob.glob(os.path.join(root, name, '*.mp4')))
+
+
+@pytest.mark.asyncio
+async def test_schedulers_share_one_limiter():
+    running = 0
+    peak = 0
+
+    async def job():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    limiter = asyncio.Semaphore(3)
+    schedulers = [Scheduler(concurrency=4, limiter=limiter) for _ in range(3)]
+    for scheduler in schedulers:
+        for index in range(8):
+            scheduler.submit(index, job)
+    await asyncio.gather(*[scheduler.join() for scheduler in schedulers])
+
+    assert 3 == peak
+
+
+@pytest.mark.asyncio
+async def test_congestion_controller_grows_additively_and_cuts_once_per_burst():
+    url = 'https://cdn.example/hls/0.ts'
+    controller = CongestionController(initial=2, maximum=5)
+
+    for _ in range(20):
+        async with controller.slot(url) as sample:
+            sample.respond()
+            sample.size = 1024
+    assert {'cdn.example': 5} == controller.limits()
+
+    async def fail():
+        with pytest.raises(aiohttp.ClientResponseError):
+            async with controller.slot(url):
+                await asyncio.sleep(0.01)
+                raise aiohttp.ClientResponseError(MagicMock(), (), status=503)
+
+    await asyncio.gather(*[fail() for _ in range(5)])
+    assert {'cdn.example': 2} == controller.limits()
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        async with controller.slot(url):
+            raise aiohttp.ClientResponseError(MagicMock(), (), status=404)
+    assert {'cdn.example': 2} == controller.limits()
+
+
+@pytest.mark.asyncio
+async def test_congestion_controller_bounds_requests_per_host():
+    controller = CongestionController(initial=3)
+    running = {'a': 0, 'b': 0}
+    peak = {'a': 0, 'b': 0}
+
+    async def fetch(host):
+        async with controller.slot(f'https://{host}/0.ts'):
+            running[host] += 1
+            peak[host] = max(peak[host], running[host])
+            await asyncio.sleep(0.01)
+            running[host] -= 1
+
+    await asyncio.gather(*[fetch(host) for host in ['a', 'b'] * 6])
+
+    assert {'a': 3, 'b': 3} == peak
+
+
+def test_backoff_grows_exponentially_with_jitter_up_to_cap():
+    backoff = Backoff(base=1, cap=10)
+
+    assert all(0 <= backoff.delay(0) <= 1 for _ in range(100))
+    assert all(0 <= backoff.delay(3) <= 8 for _ in range(100))
+    assert all(0 <= backoff.delay(20) <= 10 for _ in range(100))
+
 # def test_mediainfo():
 #     from utils import get_media_info, is_same_video
 #     target = '龍珠GT'
@@ -335,14 +1528,15 @@ def test_request():
     pass
 
 
-@pytest.fixture
-def mock_http(mocker: MockFixture):
+@pytest_asyncio.fixture
+async def mock_http(mocker: MockFixture):
     mocker.patch('aiohttp.ClientSession.get', side_effect=mock_response)
     mocker.patch('aiohttp.ClientSession.head', side_effect=mock_response)
     mocker.patch('m3u8.load', side_effect=mocked_m3u8)
 
     http = Http()
     yield http
+    await http.close()
 
 
 @pytest.fixture
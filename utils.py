@@ -1,5 +1,10 @@
+import hashlib
+
 import videoprops
 
+from mpegts import probe_file
+from profiler import TRACER
+
 
 class ANSI:
     header = '\033[95m'
@@ -14,14 +19,23 @@ class ANSI:
 
 
 class Logger:
+    # set while a progress board is drawn, so messages do not land in the middle of it
+    writer = None
 
-    @staticmethod
-    def _color(color, message):
-        print(f'\r{color}{message}{ANSI.end}')
+    @classmethod
+    def _write(cls, message):
+        if cls.writer is None:
+            print(f'\r{message}')
+        else:
+            cls.writer(message)
 
-    @staticmethod
-    def info(message):
-        print(f'\r{message}')
+    @classmethod
+    def _color(cls, color, message):
+        cls._write(f'{color}{message}{ANSI.end}')
+
+    @classmethod
+    def info(cls, message):
+        cls._write(message)
 
     def warning(self, message):
         self._color(ANSI.warning, message)
@@ -36,26 +50,6 @@ class Logger:
         self._color(ANSI.debug, message)
 
 
-def progressbar(size: int, total: int, title="Progress", color=None):
-    color_start = ''
-    color_end = ''
-
-    if color is not None:
-        color_start = color
-        color_end = ANSI.end
-
-    print('\r%s[%s]:[%s%s]%.2f%%%s' % (
-        color_start,
-        title,
-        '█' * int(size * 20 / total),
-        ' ' * (20 - int(size * 20 / total)),
-        float(size / total * 100),
-        color_end
-    ), end='')
-    # if size == total:
-    #     print('')
-
-
 def read_file(filename: str) -> bytes:
     with open(filename, 'rb') as f:
         content = f.read()
@@ -67,18 +61,35 @@ def save_file(filename: str, content: bytes):
         f.write(content)
 
 
+def checksum(filename: str, chunk_size: int = 1024 * 1024) -> str:
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
 def get_media_info(file: str) -> dict:
-    return videoprops.get_video_properties(file)
+    info = probe_file(file)
+    if info:
+        return info
 
+    # not an H.264/H.265 transport stream we can read, let ffprobe decide
+    with TRACER.span('ffprobe', 'subprocess', file=str(file)):
+        return videoprops.get_video_properties(file)
 
-def is_same_video(file: str, base_info: dict):
-    info = get_media_info(file)
-    if len(base_info) != len(info):
-        return False
 
+def is_same_media(info: dict, base_info: dict) -> bool:
     props = ['width', 'height']
+    if 'codec_name' in info and 'codec_name' in base_info:
+        props.append('codec_name')
+
     for prop in props:
-        if base_info.get(prop) != info.get(prop):
+        if str(base_info.get(prop)) != str(info.get(prop)):
             return False
 
     return True
+
+
+def is_same_video(file: str, base_info: dict):
+    return is_same_media(get_media_info(file), base_info)
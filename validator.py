@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+from merge import is_os_file
+from mpegts import PACKET_SIZE, SYNC_BYTE, find_sync, iter_packets, parse_pat, parse_pmt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NULL_PID = 0x1fff
+FRAGMENTED_EXTENSIONS = ('.m4s', '.mp4', '.cmfv', '.cmfa')
+# carried in private sections instead of PES packets, e.g. 0x86 for SCTE-35 cues
+SECTION_TYPES = {0x05, 0x0a, 0x0b, 0x0c, 0x0d, 0x86}
+
+
+class InvalidSegment(ValueError):
+    pass
+
+
+class Report:
+    def __init__(self, filename: str, packets: int = 0, errors: list = None):
+        self.filename = filename
+        self.packets = packets
+        self.errors = [] if errors is None else errors
+
+    @property
+    def ok(self) -> bool:
+        return len(self.errors) == 0
+
+    def __str__(self):
+        return '%s: %s' % (self.filename, '; '.join(self.errors) if self.errors else 'ok')
+
+
+def is_transport_stream(playlist) -> bool:
+    # fMP4/CMAF segments hang off an init section and have no sync bytes to check
+    for segment in playlist.segments:
+        if segment.init_section is not None or urlparse(segment.uri).path.lower().endswith(FRAGMENTED_EXTENSIONS):
+            return False
+
+    return True
+
+
+def get_streams(data) -> dict:
+    pmt_pids = []
+    try:
+        for pid, unit_start, payload in iter_packets(data):
+            if pid == 0 and unit_start and not pmt_pids:
+                pmt_pids = parse_pat(payload)
+            elif pid in pmt_pids and unit_start:
+                return parse_pmt(payload)
+    except IndexError:
+        pass
+
+    return {}
+
+
+def check_packets(data) -> tuple:
+    offset = find_sync(data)
+    if offset < 0:
+        return 0, ['no sync byte']
+
+    count, trailing = divmod(len(data) - offset, PACKET_SIZE)
+    errors = [] if trailing == 0 else ['truncated: %d trailing bytes' % trailing]
+    streams = get_streams(data)
+    if len(streams) == 0:
+        errors.append('no PAT/PMT')
+
+    pes = {pid for pid, stream_type in streams.items() if stream_type not in SECTION_TYPES}
+    check = check_numpy if numpy is not None else check_python
+    lost, broken, misaligned = check(data, offset, count, pes)
+    if lost is not None:
+        errors.append('sync byte lost at packet %d' % lost)
+    if broken > 0:
+        errors.append('continuity: %d errors' % broken)
+    if misaligned > 0:
+        errors.append('pes: %d misaligned starts' % misaligned)
+
+    return count, errors
+
+
+def check_numpy(data, offset: int, count: int, streams: set) -> tuple:
+    packets = numpy.frombuffer(data, numpy.uint8, count * PACKET_SIZE, offset).reshape(count, PACKET_SIZE)
+
+    lost = None
+    bad = numpy.flatnonzero(packets[:, 0] != SYNC_BYTE)
+    if bad.size > 0:
+        lost = int(bad[0])
+        packets = packets[:lost]
+
+    pids = ((packets[:, 1].astype(numpy.uint16) & 0x1f) << 8) | packets[:, 2]
+    control = (packets[:, 3] >> 4) & 0x3
+    counters = (packets[:, 3] & 0x0f).astype(numpy.int16)
+    adaptation = (control & 0x2) != 0
+    discontinuity = adaptation & (packets[:, 4] > 0) & ((packets[:, 5] & 0x80) != 0)
+    payload = ((control & 0x1) != 0) & (pids != NULL_PID)
+
+    # group payload packets by PID, keeping their order, and compare each counter with the previous one
+    rows = numpy.flatnonzero(payload)
+    rows = rows[numpy.argsort(pids[rows], kind='stable')]
+    same = pids[rows[1:]] == pids[rows[:-1]]
+    step = (counters[rows[1:]] - counters[rows[:-1]]) % 16
+    broken = int(numpy.count_nonzero(same & (step > 1) & ~discontinuity[rows[1:]]))
+
+    starts = numpy.flatnonzero(payload & ((packets[:, 1] & 0x40) != 0) & numpy.isin(pids, list(streams)))
+    offsets = 4 + numpy.where(adaptation[starts], 1 + packets[starts, 4].astype(numpy.int32), 0)
+    inside = offsets <= PACKET_SIZE - 3
+    starts, offsets = starts[inside], offsets[inside]
+    aligned = (packets[starts, offsets] == 0) & (packets[starts, offsets + 1] == 0) & (packets[starts, offsets + 2] == 1)
+    misaligned = int(numpy.count_nonzero(~aligned)) + int(numpy.count_nonzero(~inside))
+
+    return lost, broken, misaligned
+
+
+def check_python(data, offset: int, count: int, streams: set) -> tuple:
+    lost = None
+    broken = 0
+    misaligned = 0
+    counters = {}
+    for index in range(count):
+        start = offset + index * PACKET_SIZE
+        packet = data[start:start + PACKET_SIZE]
+        if packet[0] != SYNC_BYTE:
+            lost = index
+            break
+
+        pid = ((packet[1] & 0x1f) << 8) | packet[2]
+        control = (packet[3] >> 4) & 0x3
+        if not control & 0x1 or pid == NULL_PID:
+            continue
+
+        adaptation = control & 0x2
+        discontinuity = adaptation and packet[4] > 0 and packet[5] & 0x80
+        counter = packet[3] & 0x0f
+        if pid in counters and not discontinuity and (counter - counters[pid]) % 16 > 1:
+            broken += 1
+        counters[pid] = counter
+
+        if packet[1] & 0x40 and pid in streams:
+            payload = 4 + (1 + packet[4] if adaptation else 0)
+            if bytes(packet[payload:payload + 3]) != b'\x00\x00\x01':
+                misaligned += 1
+
+    return lost, broken, misaligned
+
+
+def validate(filename: str) -> Report:
+    if os.path.getsize(filename) == 0:
+        return Report(filename, 0, ['empty'])
+
+    with open(filename, 'rb') as f:
+        if not is_os_file(f):
+            packets, errors = check_packets(f.read())
+            return Report(filename, packets, errors)
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            packets, errors = check_packets(data)
+
+    return Report(filename, packets, errors)
+
+
+class Validator:
+    def __init__(self, processes: int = None, threshold: int = 4 * 1024 * 1024):
+        self.processes = processes
+        self.threshold = threshold
+        self.__executor: ProcessPoolExecutor | None = None
+
+    async def check(self, filename: str) -> Report:
+        loop = asyncio.get_event_loop()
+        # a small segment is not worth pickling to another process, but the scan still must not block the loop
+        executor = None if os.path.getsize(filename) < self.threshold else self.executor()
+
+        return await loop.run_in_executor(executor, validate, filename)
+
+    def check_all(self, files: list) -> list:
+        return list(self.executor().map(validate, files, chunksize=16))
+
+    def executor(self) -> ProcessPoolExecutor:
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(self.processes)
+
+        return self.__executor
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+        self.__executor = None
@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from m3u8 import Playlist
+
+POLICIES = ('highest', 'lowest', 'resolution', 'throughput')
+
+
+def get_bandwidth(playlist: Playlist) -> int:
+    return playlist.stream_info.bandwidth or playlist.stream_info.average_bandwidth or 0
+
+
+def get_height(playlist: Playlist) -> int:
+    resolution = playlist.stream_info.resolution
+
+    return 0 if resolution is None else resolution[1]
+
+
+class VariantSelector:
+    def __init__(self, policy: str = 'highest', resolution: int = 1080, headroom: float = 0.8, probes: int = 0):
+        if policy not in POLICIES:
+            raise ValueError('unknown variant policy: %s' % policy)
+
+        self.policy = policy
+        self.resolution = resolution
+        self.headroom = headroom
+        self.probes = probes
+
+    def rank(self, playlists: list, throughput: float = None) -> list:
+        highest = sorted(playlists, key=lambda playlist: (get_bandwidth(playlist), get_height(playlist)), reverse=True)
+
+        if self.policy == 'lowest':
+            return highest[::-1]
+
+        if self.policy == 'resolution':
+            # the sharpest variant not above the target, else the closest one above it
+            return sorted(highest, key=lambda playlist: (
+                get_height(playlist) > self.resolution,
+                abs(get_height(playlist) - self.resolution)
+            ))
+
+        if self.policy == 'throughput' and throughput:
+            # BANDWIDTH is bits per second, throughput bytes per second
+            ceiling = throughput * 8 * self.headroom
+            fits = [playlist for playlist in highest if get_bandwidth(playlist) <= ceiling]
+            return fits + [playlist for playlist in highest[::-1] if playlist not in fits]
+
+        return highest
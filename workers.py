@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+
+from batch import read_jobs
+from client import Http
+from crawlers import Page
+from main import Downloader, create, export
+from progress import ProgressBoard
+from state import StateStore
+from utils import Logger
+
+
+class QueueWorker:
+    def __init__(
+            self,
+            downloader: Downloader,
+            state: StateStore,
+            episodes: int = 1,
+            attempts: int = 3,
+            poll: float = 5
+    ):
+        self.downloader = downloader
+        self.state = state
+        self.episodes = episodes
+        self.attempts = attempts
+        self.poll = poll
+        self.__logger = Logger()
+
+    async def enqueue(self, job) -> int:
+        if job.is_page():
+            page = job.page()
+            return int(self.state.enqueue(page.name, page.episode, page.url, page.m3u8))
+
+        crawler = self.downloader.factory.create(job.spec['url'])
+        count = 0
+        async for page in crawler.pages(job.name, job.spec['url'], job.spec.get('start'), job.spec.get('end')):
+            count += self.state.enqueue(page.name, page.episode, page.url, page.m3u8, page.mirrors)
+
+        return count
+
+    async def run(self):
+        heartbeat = asyncio.ensure_future(self.__heartbeat())
+        semaphore = asyncio.Semaphore(self.episodes)
+        tasks = set()
+        try:
+            while True:
+                await semaphore.acquire()
+                entry = self.state.claim_episode()
+                if entry is not None:
+                    tasks.add(asyncio.ensure_future(self.__download(entry, semaphore)))
+                    continue
+
+                semaphore.release()
+                if len(tasks) > 0:
+                    _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                elif self.state.remaining() > 0:
+                    # the rest is leased by other workers, wait in case one of them dies
+                    await asyncio.sleep(self.poll)
+                else:
+                    return
+        finally:
+            for task in tasks:
+                task.cancel()
+            heartbeat.cancel()
+            await asyncio.gather(*tasks, heartbeat, return_exceptions=True)
+
+    async def __download(self, entry: dict, semaphore: asyncio.Semaphore):
+        page = Page(entry['name'], entry['episode'], entry['url'], entry['m3u8'], entry['mirrors'])
+        try:
+            done = await self.downloader.fetch(page)
+        except Exception as e:
+            self.__logger.error('worker: %s %s %s' % (page.name, page.episode, e))
+            done = False
+        finally:
+            semaphore.release()
+
+        retry = entry['attempts'] < self.attempts
+        self.state.finish_episode(entry['id'], 'done' if done else 'pending' if retry else 'failed')
+
+    async def __heartbeat(self):
+        # renews every lease this worker holds: queued episodes, jobs and segments
+        while True:
+            await asyncio.sleep(self.state.lease / 3)
+            self.state.heartbeat()
+
+
+async def enqueue(filename: str, root: str = 'video', journal: str = 'WAL'):
+    async with Http() as client:
+        async with create(client, root, journal=journal) as downloader:
+            worker = QueueWorker(downloader, downloader.m3u8_downloader.state)
+            for job in read_jobs(filename):
+                count = await worker.enqueue(job)
+                Logger().success('queued: %s %d episodes' % (job.name, count))
+
+
+async def work(root: str = 'video', episodes: int = 1, journal: str = 'WAL'):
+    async with Http() as client:
+        # processes share the terminal, redrawing in place would garble it
+        board = ProgressBoard(tty=False)
+        downloader = create(client, root, episodes, board, journal)
+        # one file per process, they would overwrite each other's totals
+        async with downloader, export(root, name='metrics-%d' % os.getpid()), board:
+            await QueueWorker(downloader, downloader.m3u8_downloader.state, episodes).run()
+
+
+def run_worker(root: str, episodes: int, journal: str):
+    asyncio.run(work(root, episodes, journal))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share episode downloads between processes or hosts')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    queue = commands.add_parser('enqueue', help='crawl the jobs of a JSONL file into the queue')
+    queue.add_argument('filename', nargs='?', default='jobs.jsonl')
+
+    worker = commands.add_parser('work', help='download queued episodes until the queue is empty')
+    worker.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    worker.add_argument('--episodes', type=int, default=1, help='episodes one process downloads at once')
+
+    for command in (queue, worker):
+        command.add_argument('--root', default='video', help='shared directory, also holds the queue')
+        command.add_argument(
+            '--shared',
+            action='store_true',
+            help='the root is on a network filesystem used by several hosts (rollback journal instead of WAL)'
+        )
+    args = parser.parse_args()
+    journal = 'DELETE' if args.shared else 'WAL'
+
+    if args.command == 'enqueue':
+        asyncio.run(enqueue(args.filename, args.root, journal))
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(args.root, args.episodes, journal))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()